@@ -1,33 +1,79 @@
-from flask import Flask, render_template, request, redirect, url_for, send_from_directory, session, send_file
-import pandas as pd
+import time
+_debut_demarrage = time.perf_counter()
+
+from flask import Flask, Request, render_template, request, redirect, url_for, send_from_directory, session, send_file, jsonify, stream_with_context
+from werkzeug.security import safe_join
 import os
-import matplotlib
-matplotlib.use('Agg')  # Backend non-interactif pour de meilleures performances
-import matplotlib.pyplot as plt
 import io
-import base64
 from datetime import datetime, timedelta
 import hashlib
+import tempfile
 import pickle
 from functools import lru_cache, wraps
 import json
-import gspread
-from google.oauth2.service_account import Credentials
+import sqlite3
+import threading
+import random
+import bisect
+from collections import deque, OrderedDict
+from contextlib import contextmanager, ExitStack
+try:
+    import fcntl  # Verrous de fichiers entre workers (absent sous Windows)
+except ImportError:
+    fcntl = None
+
+# pandas, matplotlib, gspread et openpyxl sont importés dans les fonctions qui en ont
+# besoin : le démarrage d'un worker ne paie ni ces imports ni aucun appel réseau.
 
 app = Flask(__name__)
 app.secret_key = 'votre_cle_secrete_a_remplacer'  # À personnaliser pour la sécurité
 
 FICHIER = "https://vincic.sharepoint.com/sites/TELT-LOT-2/_layouts/15/download.aspx?SourceUrl=/sites/TELT-LOT-2/DEX/04-LOGISTIQUE%20%26%20MATERIEL/STE/APP/Relev%C3%A9s%20STE/mesures.xlsx"  # Lecture seule depuis SharePoint
 CACHE_DIR = "cache"
-CACHE_DURATION = 3600  # 1 heure en secondes
-RAPPORTS_JSON = "rapports.json"
+CACHE_DURATION = 7 * 24 * 3600  # 7 jours : les clés suivent les données, le délai ne borne que les orphelins
+CACHE_MEMOIRE_OCTETS = 32 * 1024 * 1024  # Budget du cache mémoire de chaque processus
+CACHE_DISQUE_OCTETS = 512 * 1024 * 1024  # Budget du dossier de cache
+RENDU_VERSION = 2  # À incrémenter quand le rendu des graphiques change : les images en cache sont alors ignorées
+CACHE_RELECTURE = 300  # Secondes entre deux relectures du dossier de cache (fichiers des autres workers)
+RAPPORTS_JSON = "rapports.json"  # Ancien format de la bibliothèque, repris au premier accès
+RAPPORTS_CATALOGUE = "rapports.jsonl"  # Journal de la bibliothèque des rapports
 PHOTOS_DIR = "photos_releves"
-RELEVES_JSON = "releves_20.json"
-
-# Paramètres Google Sheets
-SERVICE_ACCOUNT_FILE = r'C:\monprojet\releves-ste-d4d0922bacfa.json'
+RELEVES_JSON = "releves_20.json"  # Ancien format des relevés, repris au premier accès
+RELEVES_CATALOGUE = "releves_20.jsonl"  # Journal des relevés photo
+PHOTO_COTE_MAX = 2048  # Plus grand côté (px) des photos conservées
+PHOTO_OCTETS_MAX = 800 * 1024  # Taille visée des photos conservées (qualité JPEG abaissée si besoin)
+PHOTO_QUALITE = 85  # Qualité JPEG de départ des photos
+MINIATURES_LARGEURS = (320, 960)  # Largeurs (px) des miniatures créées pour chaque photo
+MINIATURE_QUALITE = 80
+PHOTOS_TRAVAILLEURS = 4  # Photos traitées en parallèle (tous relevés confondus)
+PHOTOS_RECEPTION = os.path.join(PHOTOS_DIR, "reception")  # Fichiers envoyés, écrits sur disque dès leur réception
+CATALOGUE_COMPACTAGE = 200  # Lignes mortes tolérées dans un journal avant sa réécriture
+RAPPORTS_PAGE = 12  # Semaines de rapports par page de la bibliothèque
+RELEVES_PAGE = 12  # Mois de relevés par page de l'historique
+MIROIR_DB = "miroir.db"  # Copie locale des onglets Google Sheets (année en cours)
+MIROIR_ARCHIVES_DB = "miroir_archives.db"  # Partitions des années closes
+SYNCHRO_INTERVALLE = 60  # Secondes entre deux synchronisations avec Google Sheets
+
+# Paramètres Google Sheets (surchargeables par variables d'environnement)
+SERVICE_ACCOUNT_FILE = os.environ.get("GOOGLE_SERVICE_ACCOUNT_FILE", r'C:\monprojet\releves-ste-d4d0922bacfa.json')
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
-GSHEET_URL = "https://docs.google.com/spreadsheets/d/1dx1TNiG-LVU_DrjNjWkQJStvrFbJPfiwXia2owW40zA/edit"
+GSHEET_URL = os.environ.get("GSHEET_URL", "https://docs.google.com/spreadsheets/d/1dx1TNiG-LVU_DrjNjWkQJStvrFbJPfiwXia2owW40zA/edit")
+GSHEET_QUOTA_MINUTE = 50  # Requêtes par minute (quota Google : 60 par utilisateur)
+GSHEET_QUOTA_FICHIER = "quota_gsheet.txt"  # Horodatages des requêtes de la minute, communs à tous les workers
+GSHEET_ESSAIS_MAX = 5  # Tentatives pour une requête en erreur 429/5xx
+GSHEET_DELAI_MAX = 32  # Délai maximal entre deux tentatives, en secondes
+ECRITURE_REGROUPEMENT = 2  # Secondes d'attente pour regrouper les sauvegardes rapprochées d'un site
+SAISIE_ESSAIS = 3  # Tentatives d'enregistrement d'une saisie dont les lignes ont été déplacées par une synchronisation
+PLANIFICATION_INTERVALLE = 600  # Secondes entre deux passages du pré-rendu des rapports
+PLANIFICATEUR_VERROU = "planificateur.lock"  # Verrou désignant le worker qui pré-rend les rapports
+POINTS_MAX = int(os.environ.get("POINTS_MAX", 1000))  # Points au plus par courbe (réduction min/max au-delà)
+# Workers de rendu des rapports, sur option : chacun charge l'application et matplotlib,
+# trop lourd pour une petite instance. Désactivé par défaut (< 2) : les graphiques sont
+# alors rendus par un pool de RENDU_THREADS threads du processus. Borné aux processeurs
+# réellement attribués au conteneur, pas à ceux de l'hôte.
+CPU_DISPONIBLES = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+RENDU_PROCESSUS = min(int(os.environ.get("RENDU_PROCESSUS", 0)), CPU_DISPONIBLES)
+RENDU_THREADS = 4  # Graphiques rendus en parallèle par worker quand le pool de processus est désactivé
 
 # Créer les dossiers nécessaires s'ils n'existent pas
 if not os.path.exists(CACHE_DIR):
@@ -35,20 +81,23 @@ if not os.path.exists(CACHE_DIR):
 if not os.path.exists(PHOTOS_DIR):
     os.makedirs(PHOTOS_DIR)
 
-# Configuration matplotlib pour de meilleures performances
-plt.rcParams['figure.dpi'] = 100
-plt.rcParams['savefig.dpi'] = 100
-plt.rcParams['figure.figsize'] = (10, 5)
-plt.rcParams['font.size'] = 10
-
-def get_cache_key(site, parametre, semaine=None, annee=None, type_graph="default"):
-    """Génère une clé de cache unique pour un graphique"""
-    key_data = f"{site}_{parametre}_{semaine}_{annee}_{type_graph}"
-    return hashlib.md5(key_data.encode()).hexdigest()
-
-def get_cache_path(cache_key):
+def prefixe_cache(site, parametre=None, annee=None, semaine=None):
+    """Début du nom des fichiers de cache : site, année, semaine (0 : année entière), paramètre"""
+    prefixe = hashlib.md5(site.encode()).hexdigest()[:8] + "_"
+    if annee is not None:
+        prefixe += f"{annee}_{semaine or 0}_"
+        if parametre is not None:
+            prefixe += hashlib.md5(parametre.encode()).hexdigest()[:8] + "_"
+    return prefixe
+
+def get_cache_key(site, parametre, semaine=None, annee=None, type_graph="default", empreinte=""):
+    """Génère une clé de cache unique pour un graphique et l'empreinte des données dont il dépend"""
+    key_data = f"{site}_{parametre}_{semaine}_{annee}_{type_graph}_{empreinte}_{RENDU_VERSION}"
+    return prefixe_cache(site, parametre, annee, semaine) + hashlib.md5(key_data.encode()).hexdigest()
+
+def get_cache_path(cache_key, extension="png"):
     """Retourne le chemin du fichier de cache"""
-    return os.path.join(CACHE_DIR, f"{cache_key}.png")
+    return os.path.join(CACHE_DIR, f"{cache_key}.{extension}")
 
 def is_cache_valid(cache_path):
     """Vérifie si le cache est encore valide"""
@@ -57,19 +106,226 @@ def is_cache_valid(cache_path):
     file_age = datetime.now().timestamp() - os.path.getmtime(cache_path)
     return file_age < CACHE_DURATION
 
-def save_to_cache(cache_key, image_data):
-    """Sauvegarde une image en cache"""
-    cache_path = get_cache_path(cache_key)
-    with open(cache_path, 'wb') as f:
+# --- Cache des graphiques à deux niveaux ---
+# Un cache mémoire LRU par processus sert les graphiques fréquents sans aucun accès
+# disque ; le dossier de cache est tenu sous un budget en octets, les fichiers les
+# moins récemment utilisés étant supprimés au fil des écritures. L'index du dossier
+# est relu périodiquement pour voir les fichiers écrits par les autres workers.
+
+_cache_memoire = OrderedDict()  # nom de fichier -> (image, date d'écriture)
+_index_disque = None  # nom de fichier -> (taille, date d'écriture), du moins au plus récemment utilisé
+_octets = {"memoire": 0, "disque": 0}
+_index_disque_lu = 0.0
+_verrou_cache = threading.RLock()
+stats_cache = {"hits_memoire": 0, "hits_disque": 0, "miss": 0,
+               "evictions_memoire": 0, "evictions_disque": 0, "expirations": 0}
+
+def index_disque():
+    """Index du dossier de cache, relu au plus toutes les CACHE_RELECTURE secondes (verrou pris)"""
+    global _index_disque, _index_disque_lu
+    if _index_disque is not None and time.monotonic() - _index_disque_lu < CACHE_RELECTURE:
+        return _index_disque
+    maintenant = time.time()
+    fichiers = {}
+    with os.scandir(CACHE_DIR) as entrees:
+        for entree in entrees:
+            if not entree.is_file() or entree.name.endswith(".tmp"):
+                continue
+            infos = entree.stat()
+            if maintenant - infos.st_mtime >= CACHE_DURATION:
+                supprimer_fichier_cache(entree.name)
+                stats_cache["expirations"] += 1
+            else:
+                fichiers[entree.name] = (infos.st_size, infos.st_mtime)
+    index = OrderedDict(sorted(fichiers.items(), key=lambda element: element[1][1]))
+    # Les fichiers déjà connus gardent leur ordre d'utilisation
+    for nom in _index_disque or ():
+        if nom in index:
+            index.move_to_end(nom)
+    _index_disque = index
+    _index_disque_lu = time.monotonic()
+    _octets["disque"] = sum(taille for taille, _ in index.values())
+    evincer_disque()
+    nettoyer_verrous_rendu()
+    return _index_disque
+
+def supprimer_fichier_cache(nom):
+    """Supprime un fichier du dossier de cache s'il existe encore"""
+    try:
+        os.remove(os.path.join(CACHE_DIR, nom))
+    except FileNotFoundError:
+        pass
+
+def retirer_du_cache(nom, disque=False):
+    """Retire une entrée du cache mémoire, et de l'index disque si demandé (verrou pris)"""
+    entree = _cache_memoire.pop(nom, None)
+    if entree:
+        _octets["memoire"] -= len(entree[0])
+    if disque and _index_disque is not None:
+        taille = _index_disque.pop(nom, None)
+        if taille:
+            _octets["disque"] -= taille[0]
+
+def mettre_en_memoire(nom, image_data, horodatage):
+    """Place une image dans le cache mémoire et évince les moins récemment utilisées (verrou pris)"""
+    retirer_du_cache(nom)
+    _cache_memoire[nom] = (image_data, horodatage)
+    _octets["memoire"] += len(image_data)
+    while _octets["memoire"] > CACHE_MEMOIRE_OCTETS and len(_cache_memoire) > 1:
+        _, (ancienne, _) = _cache_memoire.popitem(last=False)
+        _octets["memoire"] -= len(ancienne)
+        stats_cache["evictions_memoire"] += 1
+
+def evincer_disque():
+    """Supprime les fichiers les moins récemment utilisés au-delà du budget disque (verrou pris)"""
+    while _octets["disque"] > CACHE_DISQUE_OCTETS and len(_index_disque) > 1:
+        nom, (taille, _) = _index_disque.popitem(last=False)
+        _octets["disque"] -= taille
+        supprimer_fichier_cache(nom)
+        retirer_du_cache(nom)
+        stats_cache["evictions_disque"] += 1
+
+def est_en_cache(cache_key, extension="png"):
+    """Indique si une image est en cache, sans la lire"""
+    nom = f"{cache_key}.{extension}"
+    with _verrou_cache:
+        entree = _cache_memoire.get(nom) or index_disque().get(nom)
+        if entree and time.time() - entree[1] < CACHE_DURATION:
+            return True
+    return is_cache_valid(get_cache_path(cache_key, extension))
+
+def save_to_cache(cache_key, image_data, extension="png"):
+    """Sauvegarde une image en cache (écriture atomique : jamais de fichier partiel visible)"""
+    cache_path = get_cache_path(cache_key, extension)
+    temporaire = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporaire, 'wb') as f:
         f.write(image_data)
-
-def load_from_cache(cache_key):
-    """Charge une image depuis le cache"""
-    cache_path = get_cache_path(cache_key)
-    if is_cache_valid(cache_path):
+    os.replace(temporaire, cache_path)
+    nom = os.path.basename(cache_path)
+    horodatage = time.time()
+    with _verrou_cache:
+        index = index_disque()
+        retirer_du_cache(nom, disque=True)
+        index[nom] = (len(image_data), horodatage)
+        _octets["disque"] += len(image_data)
+        mettre_en_memoire(nom, image_data, horodatage)
+        evincer_disque()
+
+def load_from_cache(cache_key, extension="png"):
+    """Charge une image depuis le cache : mémoire d'abord, puis disque"""
+    cache_path = get_cache_path(cache_key, extension)
+    nom = os.path.basename(cache_path)
+    maintenant = time.time()
+    with _verrou_cache:
+        entree = _cache_memoire.get(nom)
+        if entree and maintenant - entree[1] < CACHE_DURATION:
+            _cache_memoire.move_to_end(nom)
+            stats_cache["hits_memoire"] += 1
+            return entree[0]
+    # Le fichier peut avoir été écrit par un autre worker depuis la dernière relecture
+    image_data = None
+    try:
         with open(cache_path, 'rb') as f:
-            return f.read()
-    return None
+            horodatage = os.fstat(f.fileno()).st_mtime
+            if maintenant - horodatage < CACHE_DURATION:
+                image_data = f.read()
+    except FileNotFoundError:
+        pass
+    with _verrou_cache:
+        index = index_disque()
+        if image_data is None:
+            retirer_du_cache(nom, disque=True)
+            stats_cache["miss"] += 1
+            return None
+        if nom not in index:
+            index[nom] = (len(image_data), horodatage)
+            _octets["disque"] += len(image_data)
+        index.move_to_end(nom)
+        mettre_en_memoire(nom, image_data, horodatage)
+        stats_cache["hits_disque"] += 1
+    return image_data
+
+# --- Rendu unique d'un graphique (single-flight) ---
+# Un seul thread, tous workers confondus, rend un graphique donné : les autres
+# attendent son verrou puis relisent le cache. Le verrou est un flock sur un fichier
+# de CACHE_DIR/verrous, doublé d'un verrou de thread (seul utilisé sans fcntl).
+
+_verrous_rendu = {}  # clé -> [verrou de thread, nombre d'utilisateurs]
+_verrou_verrous_rendu = threading.Lock()
+
+def chemin_verrou_rendu(cache_key):
+    """Fichier de verrou d'une clé de cache"""
+    return os.path.join(CACHE_DIR, "verrous", f"{cache_key}.lock")
+
+@contextmanager
+def verrou_rendu(cache_key):
+    """Verrou exclusif de rendu d'une clé, entre threads et entre processus"""
+    with _verrou_verrous_rendu:
+        entree = _verrous_rendu.setdefault(cache_key, [threading.Lock(), 0])
+        entree[1] += 1
+    try:
+        with entree[0]:
+            if fcntl is None:
+                yield
+                return
+            chemin = chemin_verrou_rendu(cache_key)
+            os.makedirs(os.path.dirname(chemin), exist_ok=True)
+            while True:
+                f = open(chemin, "a")
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    # nettoyer_verrous_rendu a pu supprimer le fichier entre l'ouverture et le
+                    # flock : le verrou porterait alors sur un fichier orphelin, pas sur celui
+                    # que les autres processus ouvrent désormais à ce chemin
+                    if os.fstat(f.fileno()).st_ino == os.stat(chemin).st_ino:
+                        break
+                except FileNotFoundError:
+                    pass
+                f.close()
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                f.close()
+    finally:
+        with _verrou_verrous_rendu:
+            entree[1] -= 1
+            if not entree[1]:
+                del _verrous_rendu[cache_key]
+
+@contextmanager
+def rendu_unique(*cles):
+    """Verrous de rendu de plusieurs clés, pris dans un ordre fixe pour éviter tout interblocage"""
+    with ExitStack() as pile:
+        for cache_key in sorted(set(cles)):
+            pile.enter_context(verrou_rendu(cache_key))
+        yield
+
+def nettoyer_verrous_rendu():
+    """Supprime les fichiers de verrou anciens et libres"""
+    dossier = os.path.join(CACHE_DIR, "verrous")
+    if fcntl is None or not os.path.isdir(dossier):
+        return
+    limite = time.time() - CACHE_RELECTURE
+    for nom in os.listdir(dossier):
+        chemin = os.path.join(dossier, nom)
+        try:
+            if os.path.getmtime(chemin) > limite:
+                continue
+            with open(chemin, "a") as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                # Ne supprime que le fichier verrouillé ici, pas un successeur créé entre-temps
+                if os.fstat(f.fileno()).st_ino == os.stat(chemin).st_ino:
+                    os.remove(chemin)
+        except OSError:
+            pass  # Verrou tenu ou déjà supprimé
+
+def statistiques_cache():
+    """Compteurs et occupation du cache des graphiques"""
+    with _verrou_cache:
+        return {**stats_cache,
+                "entrees_memoire": len(_cache_memoire), "octets_memoire": _octets["memoire"],
+                "entrees_disque": len(_index_disque or ()), "octets_disque": _octets["disque"]}
 
 # Définition des mesures pour chaque site
 mesures_smp = [
@@ -109,8 +365,367 @@ debitmetres_smp = ["Exhaure 1", "Exhaure 2", "Exhaure 3", "Exhaure 4", "Retour d
 debitmetres_lpz = ["Exhaure 1", "Retour dessableur"]
 debitmetres = {"SMP": debitmetres_smp, "LPZ": debitmetres_lpz}
 
+# --- Moteur de graphiques ---
+# Chaque type de graphique est décrit par une spec : lignes retenues, calcul, abscisse
+# et titres selon la page. Le rendu passe par l'API objet de matplotlib (Figure et
+# canevas Agg) sans l'état global de pyplot ; chaque thread réutilise sa propre
+# figure pour une taille donnée, effacée au début de chaque rendu.
+
+GRAPHIQUES = {
+    "hebdo_lundi": {  # Relevé du lundi, une valeur par semaine de l'année
+        "lignes": "lundis", "calcul": None, "abscisse": "Semaine", "ordonnee": "{parametre}",
+        "titres": {"visualisation": "{parametre} hebdomadaire ({site})",
+                   "rapport": "{site} - {parametre} ({annee})"},
+    },
+    "floculant_hebdo": {  # Somme des consommations de chaque semaine de l'année
+        "lignes": "annee", "calcul": "somme_semaine", "abscisse": "Semaine", "ordonnee": "Consommation",
+        "titres": {"visualisation": "Consommation hebdomadaire de {parametre} ({site})",
+                   "rapport": "{site} - Floculant hebdo ({annee})"},
+    },
+    "delta_compteur": {  # Variation journalière d'un index de compteur
+        "lignes": "semaine", "calcul": "delta", "abscisse": "Date", "ordonnee": None,
+        "titres": {"visualisation": "Variation journalière de {parametre} - {site}",
+                   "rapport": "{site} - Delta {parametre}"},
+    },
+    "mesure_directe": {  # Valeur relevée telle quelle
+        "lignes": "semaine", "calcul": None, "abscisse": "Date", "ordonnee": None,
+        "titres": {"visualisation": "Mesure de {parametre} - {site}",
+                   "rapport": "{site} - {parametre}"},
+    },
+}
+
+# Présentation propre à chaque page
+PAGES_GRAPHIQUE = {
+    "visualisation": {"taille": (10, 5), "ordonnee": True},
+    "rapport": {"taille": (8, 4), "ordonnee": False},
+}
+
+# Formats d'image proposés pour les graphiques : type MIME et options d'enregistrement
+FORMATS_IMAGE = {
+    "png": {"mimetype": "image/png", "options": {}},
+    "svg": {"mimetype": "image/svg+xml", "options": {"metadata": {"Date": None}}},
+    "webp": {"mimetype": "image/webp", "options": {"pil_kwargs": {"lossless": True, "method": 6}}},
+}
+
+_figures = threading.local()
+
+@lru_cache(maxsize=1)
+def importer_matplotlib():
+    """Importe et configure matplotlib au premier graphique demandé"""
+    import matplotlib
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    # Configuration matplotlib pour de meilleures performances
+    matplotlib.rcParams['figure.dpi'] = 100
+    matplotlib.rcParams['savefig.dpi'] = 100
+    matplotlib.rcParams['figure.figsize'] = (10, 5)
+    matplotlib.rcParams['font.size'] = 10
+    matplotlib.rcParams['svg.fonttype'] = 'none'  # Texte SVG en <text> plutôt qu'en tracés
+    matplotlib.rcParams['svg.hashsalt'] = 'releves-ste'  # Identifiants SVG stables d'un rendu à l'autre
+    return Figure, FigureCanvasAgg
+
+def type_graphique(site, parametre):
+    """Type de graphique (clé de GRAPHIQUES) d'un paramètre"""
+    if parametre in ["Coagulant", "Eau potable"]:
+        return "hebdo_lundi"
+    if parametre == "Floculant":
+        return "floculant_hebdo"
+    if parametre in parametres_compteurs.get(site, []):
+        return "delta_compteur"
+    return "mesure_directe"
+
+def series_graphique(df, site, parametre, annee=None, semaine=None, debut=None, fin=None):
+    """Abscisses et valeurs (Series) d'un graphique à partir des mesures typées.
+
+    Les graphiques hebdomadaires couvrent toute la période ; les autres la semaine
+    demandée, ou toute la période si aucune semaine n'est donnée. La période est
+    l'année donnée, éventuellement restreinte aux dates debut..fin (incluses).
+    Sur plusieurs années, les semaines sont repérées par "AAAA-Snn"."""
+    spec = GRAPHIQUES[type_graphique(site, parametre)]
+    if annee:
+        df = df[df["Annee"] == annee]
+    if debut is not None:
+        df = df[df["Date"] >= debut]
+    if fin is not None:
+        df = df[df["Date"] <= fin]
+    if spec["lignes"] == "lundis":
+        df = df[df["Jour"] == 0]
+    elif spec["lignes"] == "semaine" and semaine:
+        df = df[df["Semaine"] == int(semaine)]
+    plusieurs_annees = spec["abscisse"] == "Semaine" and df["Annee"].nunique() > 1
+    if plusieurs_annees:
+        # Semaines repérées par leur année ISO : fin décembre peut être en semaine 1 de l'année suivante
+        df = df.assign(Annee=df["Date"].dt.isocalendar().year.astype(int))
+    if spec["calcul"] == "somme_semaine":
+        df = df.groupby(["Annee", "Semaine"])[parametre].sum().reset_index()
+        valeurs = df[parametre]
+    elif spec["calcul"] == "delta":
+        valeurs = df[parametre].fillna(0).diff().fillna(0)
+    else:
+        valeurs = df[parametre].fillna(0)
+    if spec["abscisse"] != "Semaine":
+        abscisses = df["Date"].dt.date
+    elif plusieurs_annees:
+        # Les numéros de semaine se répètent d'une année à l'autre
+        abscisses = df["Annee"].astype(str) + "-S" + df["Semaine"].astype(str).str.zfill(2)
+    else:
+        abscisses = df["Semaine"]
+    return abscisses, valeurs
+
+def reduire_serie(abscisses, valeurs, points_max):
+    """Réduit une série à points_max points au plus en gardant le minimum et le maximum de
+    chaque seau : les pics restent visibles. Entièrement vectorisé (tri par seau puis valeur)."""
+    import numpy as np
+    n = len(valeurs)
+    if n <= points_max or points_max < 4:
+        return abscisses, valeurs
+    bornes = np.linspace(0, n, (points_max - 2) // 2 + 1).astype(int)
+    seaux = np.repeat(np.arange(len(bornes) - 1), np.diff(bornes))
+    ordre = np.lexsort((valeurs.to_numpy(dtype=float), seaux))
+    # Dans chaque seau trié par valeur : premier élément = minimum, dernier = maximum
+    gardes = np.unique(np.concatenate([ordre[bornes[:-1]], ordre[bornes[1:] - 1], [0, n - 1]]))
+    return abscisses.iloc[gardes], valeurs.iloc[gardes]
+
+def figure_thread(taille):
+    """Figure réutilisée par le thread courant pour une taille donnée, et ses marges par défaut"""
+    figures = getattr(_figures, "par_taille", None)
+    if figures is None:
+        figures = _figures.par_taille = {}
+    if taille not in figures:
+        Figure, FigureCanvasAgg = importer_matplotlib()
+        figure = Figure(figsize=taille)
+        FigureCanvasAgg(figure)
+        marges = {cote: getattr(figure.subplotpars, cote) for cote in ("left", "bottom", "right", "top")}
+        figures[taille] = (figure, marges)
+    return figures[taille]
+
+def rendre_graphique(df, site, parametre, annee, semaine=None, page="rapport", format_image="png"):
+    """Rend le graphique d'un paramètre (bytes, format de FORMATS_IMAGE) ; sûr entre threads"""
+    spec = GRAPHIQUES[type_graphique(site, parametre)]
+    presentation = PAGES_GRAPHIQUE[page]
+    abscisses, valeurs = series_graphique(df, site, parametre, annee, semaine)
+    # Pas plus de points que de pixels en largeur
+    abscisses, valeurs = reduire_serie(abscisses, valeurs, min(POINTS_MAX, int(presentation["taille"][0] * 100)))
+    abscisses, valeurs = abscisses.tolist(), valeurs.tolist()
+    figure, marges = figure_thread(presentation["taille"])
+    # Axes neufs à chaque rendu : aucun réglage (rotation des étiquettes, graduations...)
+    # ne passe d'un graphique au suivant, le rendu ne dépend pas du graphique précédent
+    figure.clear()
+    figure.subplots_adjust(**marges)
+    axes = figure.add_subplot()
+    axes.plot(abscisses, valeurs, marker="o")
+    axes.set_title(spec["titres"][page].format(site=site, parametre=parametre, annee=annee))
+    if spec["abscisse"] == "Semaine":
+        axes.set_xlabel("Semaine")
+        axes.set_xticks(abscisses, ["S" + str(s) for s in abscisses])
+        if presentation["ordonnee"] and spec["ordonnee"]:
+            axes.set_ylabel(spec["ordonnee"].format(parametre=parametre))
+    else:
+        axes.tick_params(axis="x", labelrotation=45)
+    figure.tight_layout()
+    img = io.BytesIO()
+    figure.savefig(img, format=format_image, dpi=100, bbox_inches='tight', **FORMATS_IMAGE[format_image]["options"])
+    return img.getvalue()
+
+def semaine_graphique(site, parametre, semaine):
+    """Semaine dont dépend réellement un graphique (None : toute l'année)"""
+    return semaine if GRAPHIQUES[type_graphique(site, parametre)]["lignes"] == "semaine" and semaine else None
+
+@lru_cache(maxsize=8)
+def empreintes_partition(site, annee, version):
+    """Empreintes des données de chaque graphique d'une année : {(parametre, semaine ou None): empreinte}
+
+    Chaque empreinte ne couvre que les lignes et la colonne dont dépend le graphique :
+    la semaine pour les graphiques journaliers, l'année (ou ses lundis) sinon."""
+    import pandas as pd
+    df = mesures_validees_partition(site, annee, version)
+    empreintes = {}
+    for parametre in sites[site]:
+        lignes = GRAPHIQUES[type_graphique(site, parametre)]["lignes"]
+        colonne = df[df["Jour"] == 0] if lignes == "lundis" else df
+        hachage = pd.util.hash_pandas_object(colonne[["Date", parametre]], index=False)
+        empreintes[(parametre, None)] = hashlib.md5(hachage.values.tobytes()).hexdigest()
+        if lignes == "semaine":
+            for semaine, valeurs in hachage.groupby(colonne["Semaine"]):
+                empreintes[(parametre, int(semaine))] = hashlib.md5(valeurs.values.tobytes()).hexdigest()
+    return empreintes
+
+def empreinte_graphique(site, parametre, annee, semaine):
+    """Empreinte des données d'un graphique, recalculée seulement quand sa partition change"""
+    empreintes = empreintes_partition(site, annee, versions_partitions(site).get(annee, 0))
+    return empreintes.get((parametre, semaine), "")
+
+def cle_graphique(site, parametre, annee, semaine, page, format_image):
+    """Clé de cache d'un graphique, qui change dès que les données dont il dépend changent"""
+    semaine = semaine_graphique(site, parametre, semaine)
+    type_graph = page if format_image == "png" else f"{page}_{format_image}"
+    return get_cache_key(site, parametre, semaine, annee, type_graph, empreinte_graphique(site, parametre, annee, semaine))
+
+def graphiques_dependants(site, date):
+    """Graphiques touchés par une mesure validée à une date : [(parametre, annee, semaine ou None)]"""
+    jour = datetime.strptime(date, "%Y-%m-%d")
+    annee, semaine = jour.year, jour.isocalendar()[1]
+    dependants = []
+    for parametre in sites[site]:
+        lignes = GRAPHIQUES[type_graphique(site, parametre)]["lignes"]
+        if lignes == "lundis" and jour.weekday() != 0:
+            continue
+        dependants.append((parametre, annee, None))
+        if lignes == "semaine":
+            dependants.append((parametre, annee, semaine))
+    return dependants
+
+def image_graphique(site, parametre, annee, semaine=None, page="rapport", format_image="png"):
+    """Image d'un graphique, depuis le cache ou rendue puis mise en cache"""
+    cache_key = cle_graphique(site, parametre, annee, semaine, page, format_image)
+    image_data = load_from_cache(cache_key, format_image)
+    if not image_data:
+        with rendu_unique(cache_key):
+            # Un autre thread ou worker a pu le rendre pendant l'attente du verrou
+            image_data = load_from_cache(cache_key, format_image)
+            if not image_data:
+                df = mesures_validees(site, [annee])
+                image_data = rendre_graphique(df, site, parametre, annee, semaine, page, format_image)
+                save_to_cache(cache_key, image_data, format_image)
+    return image_data
+
+# --- Rendu parallèle des rapports ---
+# Les graphiques d'un rapport sont rendus dans un pool de processus (démarrage par
+# spawn, matplotlib chargé à l'initialisation de chaque worker). Les mesures typées
+# sont écrites une fois par version dans CACHE_DIR/mesures : les tâches ne transportent
+# que le chemin du fichier, que chaque worker charge une seule fois.
+
+_pool_rendu = None
+_verrou_pool_rendu = threading.Lock()
+
+def initialiser_worker_rendu():
+    """Initialisation d'un worker : matplotlib importé et polices chargées"""
+    rendre_graphique_vide()
+
+def rendre_graphique_vide():
+    """Premier rendu à blanc pour charger le moteur et le cache de polices"""
+    figure, marges = figure_thread(PAGES_GRAPHIQUE["rapport"]["taille"])
+    figure.clear()
+    figure.subplots_adjust(**marges)
+    figure.add_subplot().set_title("S1")
+    figure.savefig(io.BytesIO(), format="png")
+
+def get_pool_rendu():
+    """Pool de processus de rendu, créé à la première demande (None si désactivé)"""
+    global _pool_rendu
+    if RENDU_PROCESSUS < 2:
+        return None
+    with _verrou_pool_rendu:
+        if _pool_rendu is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            _pool_rendu = ProcessPoolExecutor(max_workers=RENDU_PROCESSUS,
+                                              mp_context=multiprocessing.get_context("spawn"),
+                                              initializer=initialiser_worker_rendu)
+        return _pool_rendu
+
+_pool_threads_rendu = None
+
+def get_pool_threads_rendu():
+    """Pool de threads de rendu, utilisé sans pool de processus (figures propres à chaque thread)"""
+    global _pool_threads_rendu
+    with _verrou_pool_rendu:
+        if _pool_threads_rendu is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _pool_threads_rendu = ThreadPoolExecutor(max_workers=RENDU_THREADS, thread_name_prefix="rendu")
+        return _pool_threads_rendu
+
+def abandonner_pool_rendu(pool):
+    """Oublie un pool dont un worker est mort ; le suivant sera recréé à la demande"""
+    global _pool_rendu
+    with _verrou_pool_rendu:
+        if _pool_rendu is pool:
+            _pool_rendu = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+@lru_cache(maxsize=8)
+def fichier_mesures_version(site, annee, version):
+    """Écrit les mesures typées d'une année pour les workers et renvoie le chemin du fichier"""
+    donnees = pickle.dumps(mesures_validees(site, [annee]), protocol=pickle.HIGHEST_PROTOCOL)
+    dossier = os.path.join(CACHE_DIR, "mesures")
+    os.makedirs(dossier, exist_ok=True)
+    prefixe = f"{site}_{annee}_"
+    chemin = os.path.join(dossier, prefixe + hashlib.md5(donnees).hexdigest() + ".pkl")
+    if not os.path.exists(chemin):
+        temporaire = f"{chemin}.{os.getpid()}.tmp"
+        with open(temporaire, "wb") as f:
+            f.write(donnees)
+        os.replace(temporaire, chemin)
+        # Les versions précédentes de la même année ne servent plus
+        for nom in os.listdir(dossier):
+            if nom.startswith(prefixe) and nom.endswith(".pkl") and os.path.join(dossier, nom) != chemin:
+                try:
+                    os.remove(os.path.join(dossier, nom))
+                except OSError:
+                    pass
+    return chemin
+
+@lru_cache(maxsize=4)
+def charger_fichier_mesures(chemin):
+    """Mesures typées lues par un worker, une seule fois par fichier"""
+    with open(chemin, "rb") as f:
+        return pickle.load(f)
+
+def rendre_graphique_worker(chemin, site, parametre, annee, semaine, page, format_image):
+    """Tâche exécutée dans un worker du pool de rendu"""
+    return rendre_graphique(charger_fichier_mesures(chemin), site, parametre, annee, semaine, page, format_image)
+
+def graphiques_rapport(site, semaine, annee, format_image="png"):
+    """Prépare les graphiques du rapport hebdomadaire d'un site et renvoie leurs paramètres
+
+    Les graphiques absents du cache sont rendus en parallèle (pool de processus s'il est
+    activé, pool de threads sinon) ; la page les référence ensuite par leur URL
+    /graphique au lieu de les embarquer."""
+    df = mesures_validees(site, [annee])
+    if df.empty:
+        return []
+    cles = {parametre: cle_graphique(site, parametre, annee, semaine, "rapport", format_image)
+            for parametre in sites[site]}
+    manquants = [parametre for parametre, cle in cles.items() if not est_en_cache(cle, format_image)]
+    if not manquants:
+        return list(sites[site])
+
+    with rendu_unique(*(cles[parametre] for parametre in manquants)):
+        # Ce qu'un autre worker a rendu pendant l'attente des verrous n'est pas refait
+        manquants = [parametre for parametre in manquants if not est_en_cache(cles[parametre], format_image)]
+        pool = get_pool_rendu() if len(manquants) > 1 else None
+        if pool is not None:
+            try:
+                chemin = fichier_mesures_version(site, annee, versions_partitions(site).get(annee, 0))
+                taches = {parametre: pool.submit(rendre_graphique_worker, chemin, site, parametre, annee, semaine,
+                                                 "rapport", format_image)
+                          for parametre in manquants}
+                for parametre, tache in taches.items():
+                    save_to_cache(cles[parametre], tache.result(), format_image)
+            except Exception as e:
+                print(f"Erreur du pool de rendu, rendu dans le processus: {e}")
+                from concurrent.futures.process import BrokenProcessPool
+                if isinstance(e, BrokenProcessPool):
+                    abandonner_pool_rendu(pool)
+        elif len(manquants) > 1:
+            taches = {parametre: get_pool_threads_rendu().submit(rendre_graphique, df, site, parametre, annee, semaine,
+                                                                 "rapport", format_image)
+                      for parametre in manquants}
+            for parametre, tache in taches.items():
+                try:
+                    save_to_cache(cles[parametre], tache.result(), format_image)
+                except Exception as e:
+                    print(f"Erreur de rendu du graphique {parametre}: {e}")
+        for parametre in manquants:
+            if not est_en_cache(cles[parametre], format_image):
+                save_to_cache(cles[parametre], rendre_graphique(df, site, parametre, annee, semaine, "rapport", format_image),
+                              format_image)
+
+    return list(sites[site])
+
 def initialiser_fichier():
     """Initialise le fichier Excel avec les colonnes nécessaires"""
+    import pandas as pd
     if not os.path.exists(FICHIER):
         print(f"Création du fichier {FICHIER}")
         dfs = {}
@@ -128,94 +743,1435 @@ def initialiser_fichier():
 @lru_cache(maxsize=10)
 def charger_donnees_cached(site, timestamp):
     """Version cachée de charger_donnees avec timestamp pour invalidation"""
-    if not os.path.exists(FICHIER):
-        initialiser_fichier()
+    import pandas as pd
     try:
-        return pd.read_excel(FICHIER, sheet_name=site, engine="openpyxl")
+        return lire_onglets_df([site])[site]
     except Exception as e:
         print(f"Erreur lors du chargement des données pour {site}: {e}")
         return pd.DataFrame(columns=["Date", "Statut"] + sites[site])
 
+# Client, classeur et onglets partagés par tout le processus : l'autorisation et les
+# métadonnées du classeur ne sont récupérées qu'une fois. Le jeton d'accès est
+# rafraîchi automatiquement par la session autorisée de gspread à son expiration.
+_gsheet = {"client": None, "classeur": None, "onglets": {}}
+_verrou_gsheet = threading.RLock()
+
 def get_gsheet_client():
-    creds = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-    return gspread.authorize(creds)
-
-def read_gsheet_as_df(sheet_name):
-    gc = get_gsheet_client()
-    sh = gc.open_by_url(GSHEET_URL)
-    worksheet = sh.worksheet(sheet_name)
-    data = worksheet.get_all_values()
+    """Retourne le client gspread du processus, autorisé une seule fois"""
+    import gspread
+    from google.oauth2.service_account import Credentials
+    with _verrou_gsheet:
+        if _gsheet["client"] is None:
+            creds = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+            _gsheet["client"] = gspread.authorize(creds)
+        return _gsheet["client"]
+
+def get_classeur():
+    """Retourne le classeur Google Sheets ouvert une seule fois par processus"""
+    with _verrou_gsheet:
+        if _gsheet["classeur"] is None:
+            _gsheet["classeur"] = get_gsheet_client().open_by_url(GSHEET_URL)
+        return _gsheet["classeur"]
+
+def get_onglet(sheet_name):
+    """Retourne l'onglet demandé depuis le cache des onglets"""
+    with _verrou_gsheet:
+        onglet = _gsheet["onglets"].get(sheet_name)
+        if onglet is None:
+            onglet = get_classeur().worksheet(sheet_name)
+            _gsheet["onglets"][sheet_name] = onglet
+        return onglet
+
+def reinitialiser_gsheet():
+    """Oublie le client, le classeur et les onglets : ils seront recréés au prochain appel"""
+    with _verrou_gsheet:
+        _gsheet["client"] = None
+        _gsheet["classeur"] = None
+        _gsheet["onglets"].clear()
+
+# Budget de requêtes Google Sheets : les appels au-delà du quota par minute
+# attendent au lieu d'échouer, et les erreurs 429/5xx sont retentées avec un
+# délai exponentiel et une part aléatoire. Le quota Google étant par utilisateur,
+# le budget est partagé par tous les workers (fichier sous flock) ; sans fcntl, il
+# n'est tenu qu'en mémoire et ne vaut que pour un seul worker.
+_appels_gsheet = deque()
+_verrou_quota = threading.Lock()
+stats_gsheet = {"appels": 0, "limitations": 0, "attente_totale": 0.0, "reessais": 0, "echecs": 0}
+
+@contextmanager
+def budget_gsheet():
+    """Horodatages des requêtes de la minute glissante, relus puis réécrits sous flock"""
+    if fcntl is None:
+        yield _appels_gsheet
+        return
+    with open(GSHEET_QUOTA_FICHIER, "a+") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            appels = deque()
+            for valeur in f.read().split():
+                try:
+                    appels.append(float(valeur))
+                except ValueError:
+                    pass  # Écriture interrompue
+            yield appels
+            f.seek(0)
+            f.truncate()
+            f.write("\n".join(repr(horodatage) for horodatage in appels))
+            f.flush()
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def reserver_appels_gsheet(nombre=1):
+    """Réserve des requêtes dans le budget de la minute glissante, en attendant si nécessaire"""
+    attente_totale = 0.0
+    while True:
+        with _verrou_quota, budget_gsheet() as appels:
+            maintenant = time.time()  # Horloge commune aux processus
+            while appels and maintenant - appels[0] >= 60:
+                appels.popleft()
+            if len(appels) + nombre <= GSHEET_QUOTA_MINUTE or not appels:
+                appels.extend([maintenant] * nombre)
+                stats_gsheet["appels"] += nombre
+                if attente_totale:
+                    stats_gsheet["limitations"] += 1
+                    stats_gsheet["attente_totale"] += attente_totale
+                    print(f"Quota Google Sheets atteint : appel retardé de {attente_totale:.1f} s")
+                return attente_totale
+            attente = 60 - (maintenant - appels[0]) + 0.05
+        time.sleep(attente)
+        attente_totale += attente
+
+def erreur_temporaire(e):
+    """Indique si une erreur Google Sheets mérite d'être retentée (quota, erreur serveur, réseau)"""
+    if isinstance(e, ErreurStockageTemporaire):
+        return True
+    import gspread
+    import requests
+    if isinstance(e, gspread.exceptions.APIError):
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+def appel_gsheet(action, nombre=1):
+    """Exécute un appel Google Sheets dans le budget de requêtes, avec réessais exponentiels"""
+    for essai in range(GSHEET_ESSAIS_MAX):
+        reserver_appels_gsheet(nombre)
+        try:
+            return action()
+        except Exception as e:
+            if not erreur_temporaire(e) or essai == GSHEET_ESSAIS_MAX - 1:
+                stats_gsheet["echecs"] += 1
+                raise
+            delai = min(GSHEET_DELAI_MAX, 2 ** essai) + random.uniform(0, 1)
+            stats_gsheet["reessais"] += 1
+            print(f"Erreur temporaire Google Sheets ({e}), nouvel essai dans {delai:.1f} s")
+            time.sleep(delai)
+
+def appel_onglet(sheet_name, action, nombre=1):
+    """Exécute action(onglet). Si le jeton est refusé ou si l'onglet a disparu,
+    les handles sont recréés et l'appel est retenté une fois."""
+    import gspread
+    try:
+        return appel_gsheet(lambda: action(get_onglet(sheet_name)), nombre)
+    except gspread.exceptions.WorksheetNotFound:
+        reinitialiser_gsheet()
+    except gspread.exceptions.APIError as e:
+        if e.response.status_code not in (401, 404):
+            raise
+        reinitialiser_gsheet()
+    return appel_gsheet(lambda: action(get_onglet(sheet_name)), nombre)
+
+def entete_unique(entete):
+    """Noms de colonnes utilisables dans le miroir : un en-tête vide devient « Colonne N »
+    (N : numéro de la colonne dans l'onglet) et un doublon reçoit un suffixe « (2) », « (3) »...
+
+    Les colonnes gardent leur position : les lignes réécrites dans l'onglet restent alignées.
+    SQLite ignorant la casse des noms de colonnes, « pH » et « PH » sont des doublons."""
+    noms, vus = [], set()
+    for i, nom in enumerate(entete):
+        nom = str(nom).strip() or f"Colonne {i + 1}"
+        candidat, n = nom, 1
+        while candidat.casefold() in vus:
+            n += 1
+            candidat = f"{nom} ({n})"
+        vus.add(candidat.casefold())
+        noms.append(candidat)
+    return noms
+
+def lignes_en_df(data):
+    """Convertit les valeurs brutes d'un onglet (en-tête en première ligne) en DataFrame"""
+    import pandas as pd
     if not data:
         return pd.DataFrame()
-    df = pd.DataFrame(data[1:], columns=data[0])
-    return df
-
-def write_df_to_gsheet(df, sheet_name):
-    gc = get_gsheet_client()
-    sh = gc.open_by_url(GSHEET_URL)
-    worksheet = sh.worksheet(sheet_name)
-    # Efface l'onglet avant d'écrire
-    worksheet.clear()
-    # Prépare les données à écrire
-    values = [df.columns.tolist()] + df.values.tolist()
-    worksheet.update('A1', values)
+    # Les lignes renvoyées par l'API omettent les cellules vides en fin de ligne
+    largeur = max(len(ligne) for ligne in data)
+    data = [list(ligne) + [""] * (largeur - len(ligne)) for ligne in data]
+    # Cellules isolées à droite du tableau ou en-tête répété : le miroir exige des noms uniques
+    return pd.DataFrame(data[1:], columns=entete_unique(data[0]))
+
+def df_en_lignes(df):
+    """Convertit un DataFrame en lignes de texte (en-tête compris) telles que stockées dans l'onglet"""
+    return [[str(c) for c in df.columns]] + df.fillna("").astype(str).values.tolist()
+
+def plages_modifiees(nouvelles, anciennes):
+    """Regroupe les lignes ajoutées ou modifiées en plages contiguës [(index_debut, lignes)]"""
+    largeur = max([len(l) for l in nouvelles] + [len(l) for l in anciennes] + [1])
+    plages = []
+    for i, ligne in enumerate(nouvelles):
+        ligne = ligne + [""] * (largeur - len(ligne))
+        if i < len(anciennes) and anciennes[i] + [""] * (largeur - len(anciennes[i])) == ligne:
+            continue
+        if plages and plages[-1][0] + len(plages[-1][1]) == i:
+            plages[-1][1].append(ligne)
+        else:
+            plages.append((i, [ligne]))
+    return plages, largeur
+
+def lire_onglets_df(noms):
+    """Lit des onglets depuis le stockage distant : {nom: DataFrame}"""
+    return {nom: lignes_en_df(lignes) for nom, lignes in get_stockage().lire_onglets(noms).items()}
+
+def ecrire_onglet_df(df, nom, precedent=None):
+    """Écrit dans l'onglet uniquement les lignes qui diffèrent de l'état distant connu (precedent).
+
+    Sans état précédent, toutes les lignes sont réécrites mais aucune ligne distante n'est
+    effacée : sans référence, une ligne absente localement n'est pas une ligne supprimée."""
+    nouvelles = df_en_lignes(df)
+    anciennes = df_en_lignes(precedent) if precedent is not None else []
+    plages, largeur = plages_modifiees(nouvelles, anciennes)
+    fin = len(anciennes) if precedent is not None else len(nouvelles)
+    get_stockage().ecrire_onglet(nom, plages, len(nouvelles), fin, largeur)
+    return len(plages)
+
+# --- Stockages distants des onglets de mesures ---
+# Le miroir local se synchronise avec l'un de ces stockages, choisi par la variable
+# d'environnement STOCKAGE_MESURES : Google Sheets (production), un fichier Excel
+# local, ou une simulation en mémoire pour mesurer les chemins d'E/S hors réseau.
+
+class ErreurStockageTemporaire(Exception):
+    """Erreur passagère du stockage (quota, indisponibilité) : l'appel peut être retenté"""
+
+class StockageDistant:
+    """Interface commune des stockages d'onglets"""
+
+    def lire_onglets(self, noms):
+        """Retourne {nom: lignes} ; chaque onglet est une liste de lignes, en-tête en premier"""
+        raise NotImplementedError
+
+    def ecrire_onglet(self, nom, plages, nb_lignes, fin, largeur):
+        """Écrit les plages [(index_debut, lignes)] puis efface les lignes de nb_lignes à fin (exclu)"""
+        raise NotImplementedError
+
+class StockageGoogleSheets(StockageDistant):
+    """Onglets du classeur GSHEET_URL, via le client partagé et le budget de requêtes"""
+
+    def lire_onglets(self, noms):
+        if len(noms) == 1:
+            return {noms[0]: appel_onglet(noms[0], lambda worksheet: worksheet.get_all_values())}
+        # Plusieurs onglets : une seule requête values_batch_get
+        plages = [f"'{nom}'" for nom in noms]
+        reponse = appel_gsheet(lambda: get_classeur().values_batch_get(plages))
+        return {nom: plage.get("values", []) for nom, plage in zip(noms, reponse.get("valueRanges", []))}
+
+    def ecrire_onglet(self, nom, plages, nb_lignes, fin, largeur):
+        appel_onglet(nom, lambda worksheet: self._ecrire(worksheet, plages, nb_lignes, fin, largeur), nombre=2)
+
+    def _ecrire(self, worksheet, plages, nb_lignes, fin, largeur):
+        from gspread.utils import rowcol_to_a1
+        if nb_lignes > worksheet.row_count:
+            worksheet.add_rows(nb_lignes - worksheet.row_count)
+        if plages:
+            worksheet.batch_update([
+                {"range": f"A{debut + 1}:{rowcol_to_a1(debut + len(lignes), largeur)}", "values": lignes}
+                for debut, lignes in plages
+            ])
+        # Lignes supprimées en fin d'onglet
+        if fin > nb_lignes:
+            worksheet.batch_clear([f"A{nb_lignes + 1}:{rowcol_to_a1(fin, largeur)}"])
+
+def appliquer_plages(lignes, plages, nb_lignes, fin):
+    """Applique des plages modifiées à une liste de lignes en mémoire"""
+    for debut, nouvelles in plages:
+        while len(lignes) < debut + len(nouvelles):
+            lignes.append([])
+        lignes[debut:debut + len(nouvelles)] = [list(l) for l in nouvelles]
+    for i in range(nb_lignes, min(fin, len(lignes))):
+        lignes[i] = []
+    while lignes and not any(lignes[-1]):
+        lignes.pop()
+    return lignes
+
+class StockageFichier(StockageDistant):
+    """Classeur Excel local, un onglet par site"""
+
+    def __init__(self, chemin):
+        self.chemin = chemin
+        self.verrou = threading.Lock()
+
+    def lire_onglets(self, noms):
+        from openpyxl import load_workbook
+        with self.verrou:
+            if not os.path.exists(self.chemin):
+                return {nom: [] for nom in noms}
+            classeur = load_workbook(self.chemin, read_only=True)
+            try:
+                return {nom: [["" if v is None else str(v) for v in ligne]
+                              for ligne in classeur[nom].iter_rows(values_only=True)]
+                        if nom in classeur.sheetnames else []
+                        for nom in noms}
+            finally:
+                classeur.close()
+
+    def ecrire_onglet(self, nom, plages, nb_lignes, fin, largeur):
+        from openpyxl import Workbook, load_workbook
+        with self.verrou:
+            classeur = load_workbook(self.chemin) if os.path.exists(self.chemin) else Workbook()
+            if nom not in classeur.sheetnames:
+                if classeur.sheetnames == ["Sheet"] and classeur["Sheet"].max_row == 1:
+                    classeur["Sheet"].title = nom
+                else:
+                    classeur.create_sheet(nom)
+            feuille = classeur[nom]
+            lignes = [["" if v is None else str(v) for v in ligne] for ligne in feuille.iter_rows(values_only=True)]
+            lignes = appliquer_plages(lignes, plages, nb_lignes, fin)
+            feuille.delete_rows(1, feuille.max_row)
+            for ligne in lignes:
+                feuille.append(ligne)
+            # Écriture atomique : le fichier n'est jamais lu à moitié écrit
+            temporaire = f"{self.chemin}.tmp"
+            classeur.save(temporaire)
+            os.replace(temporaire, self.chemin)
+
+class StockageMemoire(StockageDistant):
+    """Simulation en mémoire de Google Sheets : latence par requête, erreurs de quota
+    aléatoires et quota par minute configurables. Compte les requêtes reçues."""
+
+    def __init__(self, onglets=None, latence=0.0, taux_erreurs=0.0, quota_minute=None):
+        self.onglets = {nom: [list(l) for l in lignes] for nom, lignes in (onglets or {}).items()}
+        self.latence = latence
+        self.taux_erreurs = taux_erreurs
+        self.quota_minute = quota_minute
+        self.requetes = deque()
+        self.stats = {"lectures": 0, "ecritures": 0, "erreurs_simulees": 0}
+        self.verrou = threading.Lock()
+
+    def _requete(self):
+        if self.latence:
+            time.sleep(self.latence)
+        with self.verrou:
+            maintenant = time.monotonic()
+            while self.requetes and maintenant - self.requetes[0] >= 60:
+                self.requetes.popleft()
+            self.requetes.append(maintenant)
+            if random.random() < self.taux_erreurs or (self.quota_minute and len(self.requetes) > self.quota_minute):
+                self.stats["erreurs_simulees"] += 1
+                raise ErreurStockageTemporaire("Quota dépassé (429 simulé)")
+
+    def lire_onglets(self, noms):
+        def lire():
+            self._requete()
+            with self.verrou:
+                self.stats["lectures"] += 1
+                return {nom: [list(l) for l in self.onglets.get(nom, [])] for nom in noms}
+        return appel_gsheet(lire)
+
+    def ecrire_onglet(self, nom, plages, nb_lignes, fin, largeur):
+        def ecrire():
+            self._requete()
+            with self.verrou:
+                self.stats["ecritures"] += 1
+                appliquer_plages(self.onglets.setdefault(nom, []), plages, nb_lignes, fin)
+        appel_gsheet(ecrire, nombre=2)
+
+_stockage = {"actuel": None}
+
+def creer_stockage():
+    """Crée le stockage configuré par les variables d'environnement"""
+    type_stockage = os.environ.get("STOCKAGE_MESURES", "gsheets")
+    if type_stockage == "fichier":
+        return StockageFichier(os.environ.get("STOCKAGE_FICHIER", "mesures.xlsx"))
+    if type_stockage == "memoire":
+        return StockageMemoire(
+            onglets={site: [["Date", "Statut"] + mesures] for site, mesures in sites.items()},
+            latence=float(os.environ.get("STOCKAGE_LATENCE", "0")),
+            taux_erreurs=float(os.environ.get("STOCKAGE_TAUX_ERREURS", "0")),
+            quota_minute=int(os.environ["STOCKAGE_QUOTA_MINUTE"]) if os.environ.get("STOCKAGE_QUOTA_MINUTE") else None,
+        )
+    return StockageGoogleSheets()
+
+def get_stockage():
+    """Stockage distant utilisé par le miroir (créé au premier appel)"""
+    with _verrou_gsheet:
+        if _stockage["actuel"] is None:
+            _stockage["actuel"] = creer_stockage()
+        return _stockage["actuel"]
+
+def definir_stockage(stockage):
+    """Remplace le stockage distant, par exemple par un StockageMemoire pour un banc d'essai"""
+    with _verrou_gsheet:
+        _stockage["actuel"] = stockage
+
+# --- Miroir local des feuilles Google Sheets ---
+# Toutes les lectures sont servies par une base SQLite locale. Un thread de
+# synchronisation pousse les écritures locales vers Google Sheets et récupère
+# les modifications distantes, sans jamais bloquer une requête.
+#
+# Chaque onglet est partitionné par année (tables mesures_<site>_<année>) : une
+# requête filtrée sur une année ne lit que sa partition. Au changement d'année,
+# les partitions des années closes sont déplacées dans la base d'archives.
+
+def table_partition(site, annee):
+    """Nom de la table SQLite qui contient une année d'un onglet"""
+    return f"mesures_{site}_{annee}"
+
+def table_distante(site):
+    """Nom de la table SQLite qui contient le dernier état connu de l'onglet distant"""
+    return f"distant_{site}"
+
+def reference_partition(site, annee, archivee):
+    """Nom qualifié d'une partition, dans la base principale ou dans les archives"""
+    schema = "archives" if archivee else "main"
+    return f'"{schema}"."{table_partition(site, annee)}"'
+
+def annee_partition(date):
+    """Année de partition d'une ligne d'après sa date AAAA-MM-JJ (0 si la date est illisible)"""
+    date = str(date)
+    return int(date[:4]) if len(date) >= 5 and date[:4].isdigit() and date[4] == "-" else 0
+
+@contextmanager
+def miroir(ecriture=True):
+    """Ouvre une connexion à la base miroir, valide la transaction et la ferme"""
+    con = sqlite3.connect(MIROIR_DB, timeout=30, isolation_level=None)
+    try:
+        con.execute("ATTACH DATABASE ? AS archives", (MIROIR_ARCHIVES_DB,))
+        # Transaction explicite : le remplacement d'une table reste atomique pour les lecteurs
+        con.execute("BEGIN IMMEDIATE" if ecriture else "BEGIN")
+        try:
+            yield con
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+    finally:
+        con.close()
+
+def initialiser_miroir():
+    """Crée les tables d'état du miroir et reprend l'ancien format non partitionné"""
+    for base in (MIROIR_DB, MIROIR_ARCHIVES_DB):
+        con = sqlite3.connect(base, timeout=30)
+        try:
+            con.execute("PRAGMA journal_mode=WAL")
+        finally:
+            con.close()
+    with miroir() as con:
+        con.execute("""CREATE TABLE IF NOT EXISTS synchro (
+            site TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            version_poussee INTEGER NOT NULL DEFAULT 0,
+            derniere_synchro TEXT,
+            erreur TEXT,
+            colonnes TEXT,
+            version_partitions INTEGER NOT NULL DEFAULT 0
+        )""")
+        con.execute("""CREATE TABLE IF NOT EXISTS partitions (
+            site TEXT NOT NULL,
+            annee INTEGER NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0,
+            archivee INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (site, annee)
+        )""")
+        colonnes_synchro = [c[1] for c in con.execute("PRAGMA table_info(synchro)")]
+        if "colonnes" not in colonnes_synchro:
+            con.execute("ALTER TABLE synchro ADD COLUMN colonnes TEXT")
+        if "version_partitions" not in colonnes_synchro:
+            con.execute("ALTER TABLE synchro ADD COLUMN version_partitions INTEGER NOT NULL DEFAULT 0")
+        for site in sites:
+            ancienne = lire_table(con, f"mesures_{site}")
+            if ancienne is not None:
+                ecrire_partitions(con, site, ancienne)
+                con.execute(f'DROP TABLE "mesures_{site}"')
+        for site in sites:
+            archiver_annees_closes(con, site)
+
+class MiroirIndisponible(Exception):
+    """Le miroir d'un site n'a jamais été chargé depuis le stockage distant : les écritures
+    sont refusées, faute d'état distant auquel les rapporter"""
+
+class LignesDeplacees(Exception):
+    """Une ligne visée par sa position n'y est plus (synchronisation intervenue entre la
+    lecture et l'écriture) : la modification est annulée, à refaire après relecture"""
+
+def etat_miroir(con, site):
+    """Retourne (version, version_poussee) pour un site, ou None s'il n'a jamais été chargé.
+
+    Un site jamais chargé peut avoir une ligne synchro (erreur notée) mais pas d'en-tête."""
+    return con.execute("SELECT version, version_poussee FROM synchro WHERE site = ? AND colonnes IS NOT NULL",
+                       (site,)).fetchone()
+
+def colonnes_miroir(con, site):
+    """En-tête de l'onglet d'un site, dans l'ordre de l'onglet"""
+    ligne = con.execute("SELECT colonnes FROM synchro WHERE site = ?", (site,)).fetchone()
+    return json.loads(ligne[0]) if ligne and ligne[0] else []
+
+def partitions_site(con, site, annees=None):
+    """Partitions d'un site : [(annee, archivee, version)], éventuellement limitées à certaines années"""
+    lignes = con.execute("SELECT annee, archivee, version FROM partitions WHERE site = ? ORDER BY annee",
+                         (site,)).fetchall()
+    return [p for p in lignes if annees is None or p[0] in annees]
+
+def lire_miroir(site, annees=None):
+    """Lit un onglet depuis le miroir local, limité aux années demandées (toutes par défaut).
+
+    Retourne (df, version) ou (None, 0) si le site n'a jamais été chargé."""
+    import pandas as pd
+    with miroir(ecriture=False) as con:
+        etat = etat_miroir(con, site)
+        if etat is None:
+            return None, 0
+        colonnes = colonnes_miroir(con, site)
+        morceaux = [pd.read_sql_query(f"SELECT * FROM {reference_partition(site, annee, archivee)}", con)
+                    for annee, archivee, _ in partitions_site(con, site, annees)]
+    if not morceaux:
+        return pd.DataFrame(columns=colonnes), etat[0]
+    df = pd.concat(morceaux, ignore_index=True) if len(morceaux) > 1 else morceaux[0]
+    df = df.sort_values("_ligne").reset_index(drop=True).drop(columns="_ligne")
+    return df.reindex(columns=colonnes, fill_value=""), etat[0]
+
+def table_existe(con, table):
+    """Vrai si la table existe dans la base principale du miroir"""
+    return con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+
+def lire_table(con, table):
+    """Lit une table du miroir dans l'ordre des lignes de l'onglet, ou None si elle n'existe pas"""
+    import pandas as pd
+    if not table_existe(con, table):
+        return None
+    return pd.read_sql_query(f'SELECT * FROM "{table}" ORDER BY _ligne', con).drop(columns="_ligne")
+
+def ecrire_table(con, reference, colonnes, lignes):
+    """Remplace une table du miroir ; chaque ligne commence par sa position dans l'onglet"""
+    con.execute(f"DROP TABLE IF EXISTS {reference}")
+    definition = "".join(f', "{c}" TEXT NOT NULL DEFAULT \'\'' for c in colonnes)
+    con.execute(f"CREATE TABLE {reference} (_ligne INTEGER PRIMARY KEY{definition})")
+    if lignes:
+        marqueurs = ", ".join("?" for _ in range(len(colonnes) + 1))
+        con.executemany(f"INSERT INTO {reference} VALUES ({marqueurs})", lignes)
+
+def ecrire_table_miroir(con, table, df):
+    """Remplace le contenu d'une table du miroir par le DataFrame"""
+    valeurs = df.fillna("").astype(str).values.tolist()
+    ecrire_table(con, f'"{table}"', [str(c) for c in df.columns], [[i] + ligne for i, ligne in enumerate(valeurs)])
+
+def indexer_partition(con, site, annee, archivee):
+    """Crée l'index (Date, Statut) utilisé par les recherches de la page de saisie"""
+    table = table_partition(site, annee)
+    schema = "archives" if archivee else "main"
+    colonnes = [c[1] for c in con.execute(f'PRAGMA "{schema}".table_info("{table}")')]
+    if "Date" in colonnes and "Statut" in colonnes:
+        con.execute(f'CREATE INDEX IF NOT EXISTS "{schema}"."{table}_date_statut" ON "{table}" ("Date", "Statut")')
+
+def nouvelle_version_partition(con, site, annee, archivee=0):
+    """Déclare une partition (à sa création) ou lui donne une nouvelle version après une modification.
+
+    Les versions viennent d'un compteur par site qui ne redescend jamais : une partition
+    supprimée puis recréée ne reprend pas une version déjà mise en cache (lru_cache)."""
+    con.execute("INSERT OR IGNORE INTO synchro (site) VALUES (?)", (site,))
+    con.execute("""UPDATE synchro SET version_partitions = MAX(version_partitions,
+                       (SELECT COALESCE(MAX(version), 0) FROM partitions WHERE site = ?)) + 1
+                   WHERE site = ?""", (site, site))
+    version = con.execute("SELECT version_partitions FROM synchro WHERE site = ?", (site,)).fetchone()[0]
+    con.execute("""INSERT INTO partitions (site, annee, version, archivee) VALUES (?, ?, ?, ?)
+                   ON CONFLICT(site, annee) DO UPDATE SET version = excluded.version""",
+                (site, annee, version, archivee))
+
+def ecrire_partitions(con, site, df):
+    """Répartit un onglet complet dans les partitions annuelles du miroir.
+
+    Seules les partitions dont le contenu change sont réécrites et voient leur version
+    incrémentée. Retourne True si le miroir a changé."""
+    colonnes = [str(c) for c in df.columns]
+    lignes = df.fillna("").astype(str).values.tolist()
+    i_date = colonnes.index("Date") if "Date" in colonnes else None
+    par_annee = {}
+    for position, ligne in enumerate(lignes):
+        annee = annee_partition(ligne[i_date]) if i_date is not None else 0
+        par_annee.setdefault(annee, []).append([position] + ligne)
+
+    con.execute("INSERT OR IGNORE INTO synchro (site) VALUES (?)", (site,))
+    nouvel_entete = colonnes != colonnes_miroir(con, site)
+    change = nouvel_entete
+    existantes = {annee: archivee for annee, archivee, _ in partitions_site(con, site)}
+    for annee, archivee in existantes.items():
+        if annee not in par_annee:
+            con.execute(f"DROP TABLE IF EXISTS {reference_partition(site, annee, archivee)}")
+            con.execute("DELETE FROM partitions WHERE site = ? AND annee = ?", (site, annee))
+            change = True
+    for annee, contenu in par_annee.items():
+        archivee = existantes.get(annee, 0)
+        reference = reference_partition(site, annee, archivee)
+        if annee in existantes and not nouvel_entete:
+            actuel = [list(l) for l in con.execute(f"SELECT * FROM {reference} ORDER BY _ligne")]
+            if actuel == contenu:
+                continue
+        ecrire_table(con, reference, colonnes, contenu)
+        indexer_partition(con, site, annee, archivee)
+        nouvelle_version_partition(con, site, annee, archivee)
+        change = True
+    con.execute("UPDATE synchro SET colonnes = ? WHERE site = ?", (json.dumps(colonnes), site))
+    archiver_annees_closes(con, site)
+    return change
+
+def archiver_annees_closes(con, site):
+    """Bascule d'année : déplace dans la base d'archives les partitions des années closes"""
+    annee_courante = datetime.now().year
+    for annee, archivee, _ in partitions_site(con, site):
+        if archivee or annee == 0 or annee >= annee_courante:
+            continue
+        colonnes = colonnes_miroir(con, site)
+        lignes = [list(l) for l in con.execute(f"SELECT * FROM {reference_partition(site, annee, 0)}")]
+        ecrire_table(con, reference_partition(site, annee, 1), colonnes, lignes)
+        indexer_partition(con, site, annee, 1)
+        con.execute(f"DROP TABLE {reference_partition(site, annee, 0)}")
+        con.execute("UPDATE partitions SET archivee = 1 WHERE site = ? AND annee = ?", (site, annee))
+        print(f"Année {annee} de {site} archivée")
+
+def tirer_site(site, df=None, etat_avant=None):
+    """Met à jour le miroir avec l'onglet distant (lu ici si df n'est pas fourni),
+    s'il n'y a pas d'écriture locale en attente.
+
+    etat_avant est l'état du miroir relevé avant la lecture distante : si une écriture a été
+    enregistrée ou poussée entre-temps, la lecture est périmée et n'est pas appliquée."""
+    if df is None:
+        with miroir(ecriture=False) as con:
+            etat_avant = etat_miroir(con, site)
+        df = lire_onglets_df([site])[site]
+    with miroir() as con:
+        etat = etat_miroir(con, site)
+        if etat is not None and (etat[0] != etat[1] or etat != etat_avant):
+            # Des écritures locales sont en attente ou viennent d'être poussées
+            return False
+        if (not ecrire_partitions(con, site, df) and etat is not None
+                and table_existe(con, table_distante(site))):
+            con.execute("UPDATE synchro SET derniere_synchro = ?, erreur = NULL WHERE site = ?",
+                        (datetime.now().isoformat(), site))
+            return False
+        ecrire_table_miroir(con, table_distante(site), df)
+        version = (etat[0] if etat else 0) + 1
+        con.execute("""UPDATE synchro SET version = ?, version_poussee = ?, derniere_synchro = ?, erreur = NULL
+                       WHERE site = ?""", (version, version, datetime.now().isoformat(), site))
+    return True
 
-def charger_donnees(site):
+_verrous_ecriture = {site: threading.Lock() for site in sites}
+
+@contextmanager
+def verrou_ecriture(site):
+    """Verrou exclusif des écritures distantes d'un site, entre threads et entre processus.
+
+    Chaque worker a sa propre file d'écriture : sans ce verrou, un envoi retardé (quota,
+    nouvelle tentative) pourrait réécrire dans l'onglet une version plus ancienne que
+    celle qu'un autre worker vient d'y pousser."""
+    with _verrous_ecriture[site]:
+        if fcntl is None:
+            yield
+            return
+        with open(f"{MIROIR_DB}.ecriture-{site}.lock", "a") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def pousser_site(site):
+    """Envoie vers Google Sheets les écritures locales en attente pour un site"""
+    with verrou_ecriture(site):
+        # Lu sous le verrou : l'état distant de référence est celui du dernier envoi, quel
+        # que soit le worker qui l'a fait
+        df, version = lire_miroir(site)
+        if df is None:
+            return False
+        with miroir(ecriture=False) as con:
+            etat = etat_miroir(con, site)
+            precedent = lire_table(con, table_distante(site))
+        if etat[0] == etat[1]:
+            return False
+        if precedent is None:
+            # Sans état distant de référence, l'écriture remplacerait l'onglet au lieu de le modifier
+            raise MiroirIndisponible(f"Aucun état distant connu pour {site} : écriture suspendue "
+                                     f"pour ne pas écraser l'onglet")
+        ecrire_onglet_df(df, site, precedent)
+        with miroir() as con:
+            # L'état distant n'est remplacé que si cette version est bien la plus récente poussée
+            if con.execute("""UPDATE synchro SET version_poussee = ?, derniere_synchro = ?, erreur = NULL
+                              WHERE site = ? AND version_poussee < ?""",
+                           (version, datetime.now().isoformat(), site, version)).rowcount:
+                ecrire_table_miroir(con, table_distante(site), df)
+    return True
+
+def noter_erreur_synchro(site, e):
+    """Enregistre la dernière erreur de synchronisation d'un site, même jamais chargé"""
+    print(f"Erreur lors de la synchronisation Google Sheets pour {site}: {e}")
+    with miroir() as con:
+        con.execute("""INSERT INTO synchro (site, erreur) VALUES (?, ?)
+                       ON CONFLICT(site) DO UPDATE SET erreur = excluded.erreur""", (site, str(e)))
+
+def synchroniser_sites():
+    """Récupère tous les onglets distants en une seule requête et met à jour le miroir"""
+    with miroir(ecriture=False) as con:
+        etats = {site: etat_miroir(con, site) for site in sites}
     try:
-        df = read_gsheet_as_df(site)
-        return df
+        distants = lire_onglets_df(list(sites))
     except Exception as e:
-        print(f"Erreur lors de la lecture Google Sheets pour {site}: {e}")
-        return pd.DataFrame()
-
-def sauvegarder_donnees(df_modifie, site):
+        for site in sites:
+            noter_erreur_synchro(site, e)
+        return
+    for site, df in distants.items():
+        try:
+            tirer_site(site, df, etats[site])
+        except Exception as e:
+            noter_erreur_synchro(site, e)
+
+def boucle_synchro():
+    """Boucle du thread qui récupère périodiquement les modifications distantes"""
+    while True:
+        synchroniser_sites()
+        time.sleep(SYNCHRO_INTERVALLE)
+
+def boucle_ecriture(site):
+    """File d'écriture différée d'un site : les sauvegardes rapprochées sont regroupées
+    en une seule écriture distante. Les écritures en échec sont retentées périodiquement."""
+    reveil = _reveils_ecriture[site]
+    while True:
+        reveil.wait(SYNCHRO_INTERVALLE)
+        reveil.clear()
+        # Laisse les modifications qui arrivent en rafale se cumuler dans le miroir
+        time.sleep(ECRITURE_REGROUPEMENT)
+        try:
+            pousser_site(site)
+        except Exception as e:
+            noter_erreur_synchro(site, e)
+
+def demarrer_synchro():
+    """Démarre les threads de synchronisation une seule fois par processus"""
+    with _verrou_synchro:
+        if not _threads_synchro:
+            initialiser_miroir()
+            _threads_synchro.append(threading.Thread(target=boucle_synchro, name="synchro-gsheets", daemon=True))
+            _threads_synchro.append(threading.Thread(target=boucle_planification, name="planification-rapports",
+                                                     daemon=True))
+            for site in sites:
+                # Pousse au démarrage ce qui est resté en attente dans le miroir
+                _reveils_ecriture[site].set()
+                _threads_synchro.append(threading.Thread(target=boucle_ecriture, args=(site,),
+                                                         name=f"ecriture-{site}", daemon=True))
+            for thread in _threads_synchro:
+                thread.start()
+
+def etat_synchro(site):
+    """Résumé de la synchronisation d'un site pour l'affichage"""
+    demarrer_synchro()  # Crée les tables du miroir dans un processus qui ne l'a pas encore ouvert
+    with miroir(ecriture=False) as con:
+        ligne = con.execute("""SELECT version, version_poussee, derniere_synchro, erreur, colonnes IS NOT NULL
+                               FROM synchro WHERE site = ?""", (site,)).fetchone()
+    if ligne is None:
+        return {"site": site, "en_attente": 0, "synchronise": False, "derniere_synchro": None, "erreur": None}
+    version, version_poussee, derniere_synchro, erreur, charge = ligne
+    return {
+        "site": site,
+        "en_attente": version - version_poussee,
+        "synchronise": bool(charge) and version == version_poussee,
+        "derniere_synchro": derniere_synchro,
+        "erreur": erreur,
+    }
+
+_threads_synchro = []
+_verrou_synchro = threading.Lock()
+_reveils_ecriture = {site: threading.Event() for site in sites}
+
+def assurer_miroir(site):
+    """Amorce le miroir d'un site lors de son tout premier chargement"""
+    demarrer_synchro()
+    with miroir(ecriture=False) as con:
+        if etat_miroir(con, site) is not None:
+            return True
     try:
-        write_df_to_gsheet(df_modifie, site)
+        tirer_site(site)
+        return True
     except Exception as e:
-        print(f"Erreur lors de l'écriture Google Sheets pour {site}: {e}")
+        noter_erreur_synchro(site, e)
+        return False
+
+def charger_donnees(site):
+    import pandas as pd
+    assurer_miroir(site)
+    df, _ = lire_miroir(site)
+    return df if df is not None else pd.DataFrame()
+
+def versions_partitions(site):
+    """Versions des partitions annuelles d'un site : {annee: version}"""
+    assurer_miroir(site)
+    with miroir(ecriture=False) as con:
+        return {annee: version for annee, _, version in partitions_site(con, site)}
+
+def typer_mesures(site, df):
+    """Convertit les lignes validées d'un onglet en DataFrame typé"""
+    import pandas as pd
+    for colonne in ["Date", "Statut"] + sites[site]:
+        if colonne not in df.columns:
+            df[colonne] = ""
+    df = df[df["Statut"] == "Validé"]
+    typees = pd.DataFrame({"Date": pd.to_datetime(df["Date"], errors="coerce")})
+    for m in sites[site]:
+        typees[m] = pd.to_numeric(df[m], errors="coerce").astype(float)
+    typees = typees.dropna(subset=["Date"]).sort_values("Date", kind="stable").reset_index(drop=True)
+    typees["Annee"] = typees["Date"].dt.year
+    typees["Semaine"] = typees["Date"].dt.isocalendar().week.astype(int)
+    typees["Jour"] = typees["Date"].dt.weekday
+    return typees
+
+@lru_cache(maxsize=32)
+def mesures_validees_partition(site, annee, version):
+    """Version cachée d'une partition typée : le parsing n'est refait que si elle a changé"""
+    df, _ = lire_miroir(site, [annee])
+    return typer_mesures(site, df if df is not None else charger_donnees(site).iloc[0:0])
+
+def mesures_validees(site, annees=None):
+    """Mesures validées d'un site, typées une seule fois par version de partition.
+
+    Seules les partitions des années demandées sont lues (toutes par défaut).
+    Colonnes : Date (datetime), Annee, Semaine (ISO), Jour (0 = lundi) et une colonne float
+    par mesure de sites[site]. Le DataFrame est partagé : ne pas le modifier en place."""
+    import pandas as pd
+    versions = versions_partitions(site)
+    morceaux = [mesures_validees_partition(site, annee, version) for annee, version in sorted(versions.items())
+                if annee and (annees is None or annee in annees)]
+    if not morceaux:
+        return typer_mesures(site, pd.DataFrame(columns=["Date", "Statut"] + sites[site]))
+    return morceaux[0] if len(morceaux) == 1 else pd.concat(morceaux, ignore_index=True)
+
+def nouvelle_version_locale(con, site, etat):
+    """Incrémente la version du site après une écriture locale (à pousser vers Google Sheets)"""
+    version = (etat[0] if etat else 0) + 1
+    con.execute("""INSERT INTO synchro (site, version, version_poussee) VALUES (?, ?, 0)
+                   ON CONFLICT(site) DO UPDATE SET version = excluded.version""",
+                (site, version))
+
+# --- Accès ligne à ligne pour la page de saisie ---
+# Les recherches par (Date, Statut) passent par l'index SQLite de la partition de
+# l'année et les modifications ne touchent que les lignes concernées : le coût ne
+# dépend pas de la taille de l'historique.
+
+def lignes_du_jour(site, date, statut):
+    """Lignes du miroir pour une date et un statut, indexées par leur position dans l'onglet"""
+    import pandas as pd
+    assurer_miroir(site)
+    with miroir(ecriture=False) as con:
+        colonnes = colonnes_miroir(con, site)
+        partition = partitions_site(con, site, [annee_partition(date)])
+        if not partition or "Date" not in colonnes or "Statut" not in colonnes:
+            return pd.DataFrame(columns=colonnes or ["Date", "Statut"] + sites[site])
+        annee, archivee, _ = partition[0]
+        df = pd.read_sql_query(f'SELECT * FROM {reference_partition(site, annee, archivee)} '
+                               f'WHERE "Date" = ? AND "Statut" = ? ORDER BY _ligne',
+                               con, params=(date, statut))
+    return df.set_index("_ligne")
+
+def modifier_lignes(site, modifications=None, ajout=None, suppression=None, attendu=None):
+    """Applique au miroir des modifications ligne à ligne dans une seule transaction.
+
+    modifications : {position: {colonne: valeur}} ; ajout : dict d'une ligne à ajouter en fin
+    d'onglet ; suppression : position de la ligne à retirer. Une modification ne change pas
+    la ligne d'année : la colonne Date d'une ligne existante n'est pas modifiée ici.
+
+    attendu : (Date, Statut) des lignes visées, lus en même temps que leurs positions. Si
+    une synchronisation les a déplacées entre-temps, rien n'est écrit et LignesDeplacees
+    est levée plutôt que de modifier ou supprimer une autre ligne.
+
+    Lève MiroirIndisponible si l'onglet n'a jamais pu être lu : une écriture sans état
+    distant connu écraserait l'onglet au lieu de s'y ajouter."""
+    assurer_miroir(site)
+    with miroir() as con:
+        etat = etat_miroir(con, site)
+        if etat is None or not table_existe(con, table_distante(site)):
+            raise MiroirIndisponible(f"Les données de {site} n'ont pas encore pu être chargées depuis "
+                                     f"Google Sheets : enregistrement impossible pour l'instant, réessayez.")
+        con.execute("INSERT OR IGNORE INTO synchro (site) VALUES (?)", (site,))
+        colonnes = colonnes_miroir(con, site)
+        partitions = partitions_site(con, site)
+        nouvelles = [c for c in list((ajout or {}).keys()) + [c for v in (modifications or {}).values() for c in v]
+                     if c not in colonnes]
+        for colonne in dict.fromkeys(nouvelles):
+            for annee, archivee, _ in partitions:
+                con.execute(f'ALTER TABLE {reference_partition(site, annee, archivee)} '
+                            f'ADD COLUMN "{colonne}" TEXT NOT NULL DEFAULT \'\'')
+            colonnes.append(colonne)
+        con.execute("UPDATE synchro SET colonnes = ? WHERE site = ?", (json.dumps(colonnes), site))
+
+        condition, parametres = "_ligne = ?", []
+        if attendu is not None:
+            condition, parametres = '_ligne = ? AND "Date" = ? AND "Statut" = ?', list(attendu)
+
+        modifiees = set()
+        for ligne, valeurs in (modifications or {}).items():
+            affectations = ", ".join(f'"{c}" = ?' for c in valeurs)
+            for annee, archivee, _ in partitions:
+                curseur = con.execute(f"UPDATE {reference_partition(site, annee, archivee)} SET {affectations} "
+                                      f"WHERE {condition}",
+                                      [str(v) for v in valeurs.values()] + [int(ligne)] + parametres)
+                if curseur.rowcount:
+                    modifiees.add((annee, archivee))
+                    break
+            else:
+                if attendu is not None:
+                    raise LignesDeplacees(f"Ligne {ligne} de {site} déplacée ou modifiée depuis sa lecture")
+        if suppression is not None:
+            for annee, archivee, _ in partitions:
+                reference = reference_partition(site, annee, archivee)
+                if con.execute(f"DELETE FROM {reference} WHERE {condition}",
+                               [int(suppression)] + parametres).rowcount:
+                    modifiees.add((annee, archivee))
+            if attendu is not None and not modifiees:
+                raise LignesDeplacees(f"Ligne {suppression} de {site} déplacée ou modifiée depuis sa lecture")
+            for annee, archivee, _ in partitions:
+                reference = reference_partition(site, annee, archivee)
+                # Décalage en deux temps pour ne pas heurter l'unicité de _ligne
+                con.execute(f"UPDATE {reference} SET _ligne = -(_ligne - 1) WHERE _ligne > ?", (int(suppression),))
+                con.execute(f"UPDATE {reference} SET _ligne = -_ligne WHERE _ligne < 0")
+        if ajout:
+            suivante = max([con.execute(f"SELECT COALESCE(MAX(_ligne) + 1, 0) FROM "
+                                        f"{reference_partition(site, annee, archivee)}").fetchone()[0]
+                            for annee, archivee, _ in partitions] + [0])
+            annee = annee_partition(ajout.get("Date", ""))
+            archivee = next((a for an, a, _ in partitions if an == annee), None)
+            if archivee is None:
+                # Première ligne d'une nouvelle année : création de sa partition
+                archivee = 0
+                ecrire_table(con, reference_partition(site, annee, 0), colonnes, [])
+                indexer_partition(con, site, annee, 0)
+            noms = ", ".join(f'"{c}"' for c in ajout)
+            marqueurs = ", ".join("?" for _ in ajout)
+            con.execute(f"INSERT INTO {reference_partition(site, annee, archivee)} (_ligne, {noms}) "
+                        f"VALUES (?, {marqueurs})", [suivante] + [str(v) for v in ajout.values()])
+            modifiees.add((annee, archivee))
+        for annee, archivee in modifiees:
+            nouvelle_version_partition(con, site, annee, archivee)
+        archiver_annees_closes(con, site)
+        nouvelle_version_locale(con, site, etat)
+    _reveils_ecriture[site].set()
 
 def nettoyer_cache_expire():
-    """Nettoie automatiquement les fichiers de cache expirés"""
+    """Nettoie automatiquement les fichiers de cache expirés (relecture immédiate du dossier)"""
+    global _index_disque_lu
     try:
-        for filename in os.listdir(CACHE_DIR):
-            file_path = os.path.join(CACHE_DIR, filename)
-            if os.path.isfile(file_path) and not is_cache_valid(file_path):
-                os.remove(file_path)
+        with _verrou_cache:
+            _index_disque_lu = 0.0
+            index_disque()
     except Exception as e:
         print(f"Erreur lors du nettoyage automatique du cache: {e}")
 
-def invalider_cache_site(site):
-    """Invalide tous les caches liés à un site spécifique"""
+def invalider_cache_site(site, date=None):
+    """Invalide les caches d'un site : tous, ou seulement les graphiques touchés par une date"""
+    if date is None:
+        prefixes = (prefixe_cache(site),)
+    else:
+        prefixes = tuple(prefixe_cache(site, parametre, annee, semaine)
+                         for parametre, annee, semaine in graphiques_dependants(site, date))
     try:
-        for filename in os.listdir(CACHE_DIR):
-            if filename.startswith(hashlib.md5(site.encode()).hexdigest()[:8]):
-                file_path = os.path.join(CACHE_DIR, filename)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
+        with _verrou_cache:
+            for nom in [nom for nom in _cache_memoire if nom.startswith(prefixes)]:
+                retirer_du_cache(nom, disque=True)
+            for filename in os.listdir(CACHE_DIR):
+                if filename.startswith(prefixes):
+                    file_path = os.path.join(CACHE_DIR, filename)
+                    if os.path.isfile(file_path):
+                        os.remove(file_path)
+                        retirer_du_cache(filename, disque=True)
     except Exception as e:
         print(f"Erreur lors de l'invalidation du cache pour {site}: {e}")
+    # Une validation tardive peut changer le rapport de la semaine précédente
+    _reveil_planification.set()
+
+# --- Catalogues des rapports et relevés ---
+# Chaque catalogue est un journal JSONL auquel on ne fait qu'ajouter des lignes, une
+# par ajout ou suppression d'entrée. Les entrées sont tenues en mémoire sous leur clé,
+# (site, semaine, annee) ou (site, mois, annee) ; chaque worker rejoue à la demande les
+# lignes écrites par les autres depuis sa dernière lecture. Les écritures se font sous
+# flock d'un fichier .lock voisin, et le journal est réécrit atomiquement (compactage)
+# quand les lignes mortes s'accumulent.
+
+class Catalogue:
+    """Entrées indexées par clé, persistées dans un journal JSONL append-only"""
+
+    def __init__(self, chemin, champs_cle, ancien_json=None):
+        self.chemin = chemin
+        self.champs_cle = champs_cle
+        self.ancien_json = ancien_json
+        self._vider()
+        self.identite = None  # (st_dev, st_ino) du journal rejoué : change après un compactage
+        self.position = 0  # Octets du journal déjà rejoués
+        self.lignes = 0  # Lignes rejouées, vivantes ou mortes
+        self._verrou = threading.RLock()
+
+    def cle(self, site, *valeurs):
+        """Clé normalisée : le site en texte, le reste en entiers"""
+        return (str(site),) + tuple(int(v) for v in valeurs)
+
+    def cle_entree(self, entree):
+        return self.cle(*(entree[champ] for champ in self.champs_cle))
+
+    @contextmanager
+    def verrou(self):
+        """Verrou exclusif du journal, entre threads et entre processus"""
+        with self._verrou:
+            if fcntl is None:
+                yield
+                return
+            with open(self.chemin + ".lock", "a") as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
 
-def enregistrer_rapport(semaine, annee, site):
-    """Enregistre un rapport généré dans un fichier JSON"""
-    rapports = []
-    if os.path.exists(RAPPORTS_JSON):
-        with open(RAPPORTS_JSON, "r", encoding="utf-8") as f:
+    def a_jour(self):
+        """Vrai si le journal n'a pas changé depuis la dernière lecture"""
+        try:
+            st = os.stat(self.chemin)
+        except OSError:
+            return False
+        return (st.st_dev, st.st_ino) == self.identite and st.st_size == self.position
+
+    def rang(self, cle):
+        """Rang de tri d'une clé (site, période, année) : par année, période puis site"""
+        site, periode, annee = cle
+        return annee, periode, site
+
+    def _vider(self):
+        self.entrees = {}
+        self.tri = []  # Rangs des entrées, croissants
+
+    def _appliquer(self, ligne):
+        if ligne["op"] == "ajout":
+            cle = self.cle_entree(ligne["entree"])
+            if cle not in self.entrees:
+                bisect.insort(self.tri, self.rang(cle))
+            self.entrees[cle] = ligne["entree"]
+            return
+        cle = self.cle(*ligne["cle"])
+        if self.entrees.pop(cle, None) is not None:
+            del self.tri[bisect.bisect_left(self.tri, self.rang(cle))]
+
+    def _rejouer(self):
+        """Applique les lignes écrites depuis la dernière lecture (verrou tenu)"""
+        if not os.path.exists(self.chemin):
+            self._migrer()
+        with open(self.chemin, "rb") as f:
+            st = os.fstat(f.fileno())
+            if (st.st_dev, st.st_ino) != self.identite:
+                # Journal compacté par un autre worker : relecture complète
+                self._vider()
+                self.position, self.lignes = 0, 0
+                self.identite = (st.st_dev, st.st_ino)
+            f.seek(self.position)
+            donnees = f.read()
+        # Une ligne inachevée (écriture interrompue) n'est pas rejouée
+        fin = donnees.rfind(b"\n") + 1
+        for ligne in donnees[:fin].splitlines():
+            if not ligne.strip():
+                continue
+            try:
+                self._appliquer(json.loads(ligne))
+            except (ValueError, KeyError, TypeError) as e:
+                print(f"Ligne ignorée dans {self.chemin}: {e}")
+            self.lignes += 1
+        self.position += fin
+
+    def _reecrire(self):
+        """Réécrit atomiquement le journal avec les seules entrées vivantes (verrou tenu)"""
+        tmp = self.chemin + ".tmp"
+        with open(tmp, "wb") as f:
+            for entree in self.entrees.values():
+                f.write((json.dumps({"op": "ajout", "entree": entree}, ensure_ascii=False) + "\n").encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+            st = os.fstat(f.fileno())
+            taille = f.tell()
+        os.replace(tmp, self.chemin)
+        self.identite, self.position, self.lignes = (st.st_dev, st.st_ino), taille, len(self.entrees)
+
+    def _migrer(self):
+        """Crée le journal en reprenant l'ancien fichier JSON s'il existe (verrou tenu)"""
+        self._vider()
+        if self.ancien_json and os.path.exists(self.ancien_json):
             try:
-                rapports = json.load(f)
-            except Exception:
-                rapports = []
-    # On évite les doublons exacts
-    for r in rapports:
-        if r["semaine"] == semaine and r["annee"] == annee and r["site"] == site:
+                with open(self.ancien_json, "r", encoding="utf-8") as f:
+                    for entree in json.load(f):
+                        if self.cle_entree(entree) not in self.entrees:
+                            self._appliquer({"op": "ajout", "entree": entree})
+                print(f"{len(self.entrees)} entrées reprises de {self.ancien_json}")
+            except Exception as e:
+                print(f"Erreur lors de la reprise de {self.ancien_json}: {e}")
+        self._reecrire()
+
+    def _ecrire(self, ligne):
+        """Ajoute une ligne au journal puis l'applique en mémoire (verrou tenu, journal rejoué)"""
+        donnees = (json.dumps(ligne, ensure_ascii=False) + "\n").encode("utf-8")
+        with open(self.chemin, "r+b") as f:
+            f.truncate(self.position)  # Retire une éventuelle ligne inachevée
+            f.seek(self.position)
+            f.write(donnees)
+            f.flush()
+            os.fsync(f.fileno())
+        self.position += len(donnees)
+        self.lignes += 1
+        self._appliquer(ligne)
+        if self.lignes - len(self.entrees) > CATALOGUE_COMPACTAGE:
+            self._reecrire()
+
+    def synchroniser(self):
+        """Rejoue les lignes écrites par les autres workers, si besoin"""
+        with self._verrou:
+            if not self.a_jour():
+                with self.verrou():
+                    self._rejouer()
+
+    def ajouter(self, entree, remplacer=False):
+        """Ajoute une entrée ; renvoie False si la clé existe déjà (sauf remplacer)"""
+        with self.verrou():
+            self._rejouer()
+            if not remplacer and self.cle_entree(entree) in self.entrees:
+                return False
+            self._ecrire({"op": "ajout", "entree": entree})
+            return True
+
+    def retirer(self, *cle):
+        """Retire l'entrée d'une clé ; renvoie l'entrée retirée ou None"""
+        cle = self.cle(*cle)
+        with self.verrou():
+            self._rejouer()
+            entree = self.entrees.get(cle)
+            if entree is not None:
+                self._ecrire({"op": "suppression", "cle": list(cle)})
+            return entree
+
+    def get(self, *cle):
+        self.synchroniser()
+        with self._verrou:
+            return self.entrees.get(self.cle(*cle))
+
+    def valeurs(self):
+        self.synchroniser()
+        with self._verrou:
+            return list(self.entrees.values())
+
+    def page(self, avant=None, periodes=12, site=None):
+        """Entrées des `periodes` périodes les plus récentes antérieures au curseur `avant`
+        ((annee, periode), exclu), d'un seul site si demandé.
+
+        Renvoie (entrées de la plus récente à la plus ancienne, curseur de la page
+        suivante ou None)."""
+        self.synchroniser()
+        with self._verrou:
+            i = len(self.tri) if avant is None else bisect.bisect_left(self.tri, (avant[0], avant[1], ""))
+            entrees, derniere, nombre = [], None, 0
+            while i > 0:
+                annee, periode, site_entree = self.tri[i - 1]
+                if site is None or site_entree == site:
+                    if (annee, periode) != derniere:
+                        if nombre == periodes:
+                            break
+                        derniere, nombre = (annee, periode), nombre + 1
+                    entrees.append(self.entrees[(site_entree, periode, annee)])
+                i -= 1
+            return entrees, (derniere if i > 0 else None)
+
+class CatalogueRapports(Catalogue):
+    """Bibliothèque des rapports, avec sa table croisée année → semaine → site.
+
+    La table est tenue à jour à chaque ligne appliquée (écriture locale ou rejouée),
+    et les années présentes restent triées : une page d'année se lit sans parcourir
+    la bibliothèque."""
+
+    def _vider(self):
+        super()._vider()
+        self.table = {}  # annee -> semaine -> site -> entrée
+        self.annees = []  # Années présentes, croissantes
+
+    def _appliquer(self, ligne):
+        super()._appliquer(ligne)
+        if ligne["op"] == "ajout":
+            site, semaine, annee = self.cle_entree(ligne["entree"])
+            if annee not in self.table:
+                self.table[annee] = {}
+                bisect.insort(self.annees, annee)
+            self.table[annee].setdefault(semaine, {})[site] = ligne["entree"]
             return
-    rapports.append({
+        site, semaine, annee = self.cle(*ligne["cle"])
+        semaines = self.table.get(annee, {})
+        semaines.get(semaine, {}).pop(site, None)
+        if semaine in semaines and not semaines[semaine]:
+            del semaines[semaine]
+        if annee in self.table and not semaines:
+            del self.table[annee]
+            self.annees.remove(annee)
+
+    def annees_table(self):
+        """Années de la bibliothèque, de la plus récente à la plus ancienne"""
+        self.synchroniser()
+        with self._verrou:
+            return self.annees[::-1]
+
+    def semaines_table(self, annee):
+        """[(semaine, {site: entrée})] d'une année, de la semaine la plus récente à la plus ancienne"""
+        self.synchroniser()
+        with self._verrou:
+            semaines = self.table.get(annee, {})
+            return [(semaine, dict(semaines[semaine])) for semaine in sorted(semaines, reverse=True)]
+
+catalogue_rapports = CatalogueRapports(RAPPORTS_CATALOGUE, ("site", "semaine", "annee"), RAPPORTS_JSON)
+catalogue_releves = Catalogue(RELEVES_CATALOGUE, ("site", "mois", "annee"), RELEVES_JSON)
+
+def enregistrer_rapport(semaine, annee, site):
+    """Inscrit un rapport généré dans la bibliothèque (sans doublon)"""
+    catalogue_rapports.ajouter({
         "semaine": semaine,
         "annee": annee,
         "site": site,
         "timestamp": datetime.now().isoformat()
     })
-    with open(RAPPORTS_JSON, "w", encoding="utf-8") as f:
-        json.dump(rapports, f, ensure_ascii=False, indent=2)
+
+def table_croisee_rapports(sites_list, annee):
+    """Lignes année/semaine × sites de la bibliothèque pour une année"""
+    return [dict({"annee": annee, "semaine": semaine}, **{site: rapports.get(site) for site in sites_list})
+            for semaine, rapports in catalogue_rapports.semaines_table(annee)]
+
+def page_table_rapports(sites_list, annee_table=None):
+    """Page d'une année de la table croisée (la plus récente par défaut) et années disponibles"""
+    annees_table = catalogue_rapports.annees_table()
+    if annee_table not in annees_table:
+        annee_table = annees_table[0] if annees_table else None
+    table_rapports = table_croisee_rapports(sites_list, annee_table) if annee_table else []
+    return {"table_rapports": table_rapports, "annees_table": annees_table, "annee_table": annee_table}
+
+# --- Pré-rendu planifié des rapports ---
+# Un seul worker, élu par un verrou de fichier, pré-rend le rapport de la semaine ISO
+# précédente de chaque site et l'inscrit dans la bibliothèque. Les clés de cache
+# suivant les données, un passage ne rend que les graphiques modifiés depuis le
+# précédent : une validation tardive est reprise au passage suivant, déclenché
+# immédiatement par l'invalidation du cache.
+
+_reveil_planification = threading.Event()
+etat_planification = {"actif": False, "dernier_passage": None, "erreur": None}
+
+def prendre_verrou_planificateur():
+    """Tente de devenir le worker planificateur ; renvoie le fichier verrouillé ou None"""
+    if fcntl is None:
+        return True  # Sans verrous de fichiers : un seul processus en développement
+    f = open(PLANIFICATEUR_VERROU, "a")
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return f  # Gardé ouvert : le verrou tient tant que le processus vit
+    except OSError:
+        f.close()
+        return None
+
+def semaine_precedente(maintenant=None):
+    """(annee, semaine) ISO de la semaine close la plus récente"""
+    annee, semaine, _ = ((maintenant or datetime.now()) - timedelta(days=7)).isocalendar()
+    return annee, semaine
+
+def prerendre_rapports(maintenant=None):
+    """Pré-rend le rapport de la semaine précédente de chaque site et l'enregistre"""
+    annee, semaine = semaine_precedente(maintenant)
+    for site in sites:
+        if graphiques_rapport(site, semaine, annee):
+            enregistrer_rapport(semaine, annee, site)
+
+def boucle_planification():
+    """Boucle du thread de pré-rendu ; les workers non élus retentent à chaque passage"""
+    verrou = None
+    while True:
+        try:
+            if verrou is None:
+                verrou = prendre_verrou_planificateur()
+            etat_planification["actif"] = verrou is not None
+            if verrou is not None:
+                prerendre_rapports()
+                etat_planification["dernier_passage"] = datetime.now().isoformat()
+                etat_planification["erreur"] = None
+        except Exception as e:
+            etat_planification["erreur"] = str(e)
+            print(f"Erreur lors du pré-rendu des rapports: {e}")
+        _reveil_planification.wait(PLANIFICATION_INTERVALLE)
+        _reveil_planification.clear()
+
+# --- Export des rapports en PDF ou en ZIP ---
+# Les exports sont produits en flux : chaque graphique est lu dans le cache (ou rendu)
+# puis aussitôt émis, sans construire le document en mémoire. Un export peut couvrir
+# plusieurs semaines et plusieurs sites.
+
+EXPORT_SEMAINES_MAX = 53  # Semaines au plus par export
+
+def semaines_export(annee, semaine, annee_fin=None, semaine_fin=None):
+    """Semaines ISO (annee, semaine) d'un export, bornes incluses"""
+    from datetime import date
+    jour = date.fromisocalendar(annee, semaine, 1)
+    fin = date.fromisocalendar(annee_fin or annee, semaine_fin or semaine, 1)
+    semaines = []
+    while jour <= fin and len(semaines) < EXPORT_SEMAINES_MAX:
+        semaines.append(tuple(jour.isocalendar()[:2]))
+        jour += timedelta(days=7)
+    return semaines
+
+def images_export(sites_export, semaines):
+    """Graphiques d'un export, produits un par un : (site, annee, semaine, parametre, image PNG)"""
+    for site in sites_export:
+        for annee, semaine in semaines:
+            if mesures_validees(site, [annee]).empty:
+                continue
+            for parametre in sites[site]:
+                yield site, annee, semaine, parametre, image_graphique(site, parametre, annee, semaine, "rapport", "png")
+
+def nom_export(parametre):
+    """Nom de fichier sans caractère gênant pour un paramètre"""
+    return "".join(c if c.isalnum() or c in " -" else "_" for c in parametre)
+
+class FluxEcriture(io.RawIOBase):
+    """Fichier en écriture seule, non positionnable, dont le contenu est repris par morceaux"""
+
+    def __init__(self):
+        super().__init__()
+        self.morceaux = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.morceaux.append(bytes(data))
+        return len(data)
+
+    def vider(self):
+        data = b"".join(self.morceaux)
+        self.morceaux = []
+        return data
+
+def flux_zip(images):
+    """Archive ZIP des graphiques, émise au fil des images (un dossier par site et semaine)"""
+    import zipfile
+    flux = FluxEcriture()
+    with zipfile.ZipFile(flux, "w", zipfile.ZIP_STORED) as archive:
+        for site, annee, semaine, parametre, image_data in images:
+            info = zipfile.ZipInfo(f"{site}/{annee}-S{semaine:02d}/{nom_export(parametre)}.png",
+                                   date_time=datetime.now().timetuple()[:6])
+            archive.writestr(info, image_data)
+            yield flux.vider()
+    yield flux.vider()
+
+class PdfFlux:
+    """Écriture d'un PDF en flux : chaque objet est émis dès qu'il est prêt et sa
+    position retenue pour la table des références, écrite à la fin.
+
+    Objets fixes : 1 catalogue, 2 arbre des pages (émis en dernier), 3 police."""
+
+    LARGEUR, HAUTEUR, MARGE = 595, 842, 36  # A4 portrait, en points
+
+    def __init__(self):
+        self.position = 0
+        self.positions = {}
+        self.pages = []
+        self.suivant = 4
+
+    def objet(self, numero, dictionnaire, flux=None):
+        self.positions[numero] = self.position
+        data = f"{numero} 0 obj\n".encode() + dictionnaire
+        if flux is not None:
+            data += b"\nstream\n" + flux + b"\nendstream"
+        data += b"\nendobj\n"
+        self.position += len(data)
+        return data
+
+    def numero(self):
+        self.suivant += 1
+        return self.suivant - 1
+
+    @staticmethod
+    def texte(contenu):
+        """Chaîne PDF littérale (police standard en WinAnsi)"""
+        octets = contenu.encode("cp1252", "replace")
+        return b"(" + octets.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+    def debut(self):
+        entete = b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"
+        self.position = len(entete)
+        return entete + self.objet(3, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica "
+                                      b"/Encoding /WinAnsiEncoding >>")
+
+    def image(self, image_data):
+        """Objet image d'un PNG (converti en RVB compressé) : (octets, (numero, largeur, hauteur))"""
+        import zlib
+        from PIL import Image
+        with Image.open(io.BytesIO(image_data)) as img:
+            rvb = img.convert("RGB")
+        largeur, hauteur = rvb.size
+        pixels = zlib.compress(rvb.tobytes(), 6)
+        numero = self.numero()
+        dictionnaire = (f"<< /Type /XObject /Subtype /Image /Width {largeur} /Height {hauteur} "
+                        f"/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /FlateDecode "
+                        f"/Length {len(pixels)} >>").encode()
+        return self.objet(numero, dictionnaire, pixels), (numero, largeur, hauteur)
+
+    def page(self, titre, blocs):
+        """Page avec un titre et jusqu'à deux graphiques [(legende, (numero, largeur, hauteur))]"""
+        haut = self.HAUTEUR - self.MARGE
+        contenu = [b"BT /F1 14 Tf %d %d Td " % (self.MARGE, haut - 14) + self.texte(titre) + b" Tj ET"]
+        hauteur_bloc = (haut - 30 - self.MARGE) / 2
+        ressources = []
+        for i, (legende, (numero, largeur, hauteur)) in enumerate(blocs):
+            y_bloc = haut - 30 - i * hauteur_bloc
+            echelle = min((self.LARGEUR - 2 * self.MARGE) / largeur, (hauteur_bloc - 24) / hauteur)
+            l, h = largeur * echelle, hauteur * echelle
+            x = (self.LARGEUR - l) / 2
+            contenu.append(b"BT /F1 11 Tf %d %.2f Td " % (self.MARGE, y_bloc - 14) + self.texte(legende) + b" Tj ET")
+            contenu.append(b"q %.2f 0 0 %.2f %.2f %.2f cm /Im%d Do Q" % (l, h, x, y_bloc - 20 - h, numero))
+            ressources.append(b"/Im%d %d 0 R" % (numero, numero))
+        flux = b"\n".join(contenu)
+        numero_contenu, numero_page = self.numero(), self.numero()
+        self.pages.append(numero_page)
+        return (self.objet(numero_contenu, b"<< /Length %d >>" % len(flux), flux)
+                + self.objet(numero_page, b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] "
+                                          b"/Resources << /Font << /F1 3 0 R >> /XObject << %s >> >> "
+                                          b"/Contents %d 0 R >>"
+                             % (self.LARGEUR, self.HAUTEUR, b" ".join(ressources), numero_contenu)))
+
+    def fin(self):
+        kids = b" ".join(b"%d 0 R" % numero for numero in self.pages)
+        data = self.objet(2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self.pages)))
+        data += self.objet(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        xref = self.position
+        nombre = self.suivant
+        lignes = [b"xref\n0 %d\n" % nombre, b"0000000000 65535 f \n"]
+        for numero in range(1, nombre):
+            lignes.append(b"%010d 00000 n \n" % self.positions[numero])
+        lignes.append(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (nombre, xref))
+        return data + b"".join(lignes)
+
+def flux_pdf(images):
+    """PDF du rapport, deux graphiques par page, émis au fil des images"""
+    pdf = PdfFlux()
+    yield pdf.debut()
+    blocs, groupe = [], None
+    for site, annee, semaine, parametre, image_data in images:
+        if blocs and (len(blocs) == 2 or groupe != (site, annee, semaine)):
+            yield pdf.page(f"{groupe[0]} - Semaine {groupe[2]} / {groupe[1]}", blocs)
+            blocs = []
+        groupe = (site, annee, semaine)
+        data, image = pdf.image(image_data)
+        yield data
+        blocs.append((parametre, image))
+    if blocs:
+        yield pdf.page(f"{groupe[0]} - Semaine {groupe[2]} / {groupe[1]}", blocs)
+    if not pdf.pages:
+        yield pdf.page("Aucune donnée pour cette sélection", [])
+    yield pdf.fin()
 
 # Page de connexion
 @app.route('/login', methods=['GET', 'POST'])
@@ -252,16 +2208,61 @@ def require_access(min_code):
 def index():
     return render_template("index.html")
 
+def enregistrer_saisie(site, today_date, brouillon, valide):
+    """Traite l'envoi du formulaire de saisie (choix après alerte, sauvegarde ou validation)"""
+    mesures = sites[site]
+    today_str = today_date.strftime("%Y-%m-%d")
+    if "choix" in request.form:
+        choix = request.form["choix"]
+        if choix == "annuler":
+            return redirect("/")
+        elif choix == "ecraser":
+            if not valide.empty:
+                modifier_lignes(site, suppression=valide.index[-1], attendu=(today_str, "Validé"))
+                invalider_cache_site(site, today_str)
+            return redirect(url_for("saisie", site=site))
+        elif choix == "nouveau":
+            ligne = {"Date": today_str, "Statut": "Brouillon"}
+            for m in mesures:
+                ligne[m] = ""
+            modifier_lignes(site, ajout=ligne)
+            return redirect(url_for("saisie", site=site))
+        elif choix == "modifier":
+            if not valide.empty:
+                modifier_lignes(site, modifications={valide.index[-1]: {"Statut": "Brouillon"}},
+                                attendu=(today_str, "Validé"))
+                invalider_cache_site(site, today_str)
+            return redirect(url_for("saisie", site=site))
+
+    ligne = {"Date": today_str, "Statut": "Brouillon"}
+    for m in mesures:
+        if m in ["Coagulant", "Eau potable"] and today_date.weekday() != 0:
+            ligne[m] = ""
+        else:
+            ligne[m] = request.form.get(m) or ""
+
+    finaliser = "finaliser" in request.form
+    if not brouillon.empty:
+        modifications = {idx: {"Statut": "Validé"} for idx in brouillon.index} if finaliser else {}
+        modifications[brouillon.index[0]] = dict(ligne, Statut="Validé" if finaliser else "Brouillon")
+        modifier_lignes(site, modifications=modifications, attendu=(today_str, "Brouillon"))
+    else:
+        modifier_lignes(site, ajout=dict(ligne, Statut="Validé" if finaliser else "Brouillon"))
+    if finaliser:
+        invalider_cache_site(site, today_str)
+
+    message = "Mesure validée." if "finaliser" in request.form else "Brouillon sauvegardé."
+    return render_template("confirmation.html", message=message, synchro=etat_synchro(site))
+
 @app.route("/saisie/<site>", methods=["GET", "POST"])
 @require_access(12)
 def saisie(site):
     mesures = sites[site]
-    df = charger_donnees(site)
     today_date = datetime.now()
     today_str = today_date.strftime("%Y-%m-%d")
 
     yesterday = (today_date - timedelta(days=1)).strftime("%Y-%m-%d")
-    veille = df[(df["Date"] == yesterday) & (df["Statut"] == "Validé")]
+    veille = lignes_du_jour(site, yesterday, "Validé")
 
     valeurs_veille = {}
     for m in mesures:
@@ -269,62 +2270,30 @@ def saisie(site):
         if not veille.empty:
             valeurs_veille[m] = veille[m].iloc[-1]
 
-    brouillon = df[(df["Date"] == today_str) & (df["Statut"] == "Brouillon")]
-    valide = df[(df["Date"] == today_str) & (df["Statut"] == "Validé")]
+    brouillon = lignes_du_jour(site, today_str, "Brouillon")
+    valide = lignes_du_jour(site, today_str, "Validé")
 
+    erreur = None
     if request.method == "POST":
-        if "choix" in request.form:
-            choix = request.form["choix"]
-            if choix == "annuler":
-                return redirect("/")
-            elif choix == "ecraser":
-                valid_today = df[(df["Date"] == today_str) & (df["Statut"] == "Validé")]
-                if not valid_today.empty:
-                    last_idx = valid_today.index[-1]
-                    df = df.drop(last_idx)
-                sauvegarder_donnees(df, site)
-                return redirect(url_for("saisie", site=site))
-            elif choix == "nouveau":
-                ligne = {"Date": today_str, "Statut": "Brouillon"}
-                for m in mesures:
-                    ligne[m] = ""
-                df.loc[len(df)] = ligne
-                sauvegarder_donnees(df, site)
-                return redirect(url_for("saisie", site=site))
-            elif choix == "modifier":
-                valid_today = df[(df["Date"] == today_str) & (df["Statut"] == "Validé")]
-                if not valid_today.empty:
-                    last_idx = valid_today.index[-1]
-                    df.loc[last_idx, "Statut"] = "Brouillon"
-                    sauvegarder_donnees(df, site)
-                return redirect(url_for("saisie", site=site))
-
-        ligne = {"Date": today_str, "Statut": "Brouillon"}
-        for m in mesures:
-            if m in ["Coagulant", "Eau potable"] and today_date.weekday() != 0:
-                ligne[m] = ""
-            else:
-                ligne[m] = request.form.get(m) or ""
-
-        if not brouillon.empty:
-            idx = brouillon.index[0]
-            for k, v in ligne.items():
-                if k in ["Coagulant", "Eau potable"] and today_date.weekday() != 0:
-                    df.loc[idx, k] = ""
-                else:
-                    df.loc[idx, k] = v
+        for _ in range(SAISIE_ESSAIS):
+            try:
+                return enregistrer_saisie(site, today_date, brouillon, valide)
+            except LignesDeplacees as e:
+                # Une synchronisation a déplacé les lignes du jour : relecture et nouvel essai
+                print(f"Saisie de {site} à refaire: {e}")
+                brouillon = lignes_du_jour(site, today_str, "Brouillon")
+                valide = lignes_du_jour(site, today_str, "Validé")
+            except MiroirIndisponible as e:
+                print(f"Saisie refusée pour {site}: {e}")
+                erreur = str(e)
+                break
         else:
-            df.loc[len(df)] = ligne
-
-        if "finaliser" in request.form:
-            df.loc[(df["Date"] == today_str) & (df["Statut"] == "Brouillon"), "Statut"] = "Validé"
-
-        sauvegarder_donnees(df, site)
-        message = "Mesure validée." if "finaliser" in request.form else "Brouillon sauvegardé."
-        return render_template("confirmation.html", message=message)
+            erreur = "Les données ont changé pendant l'enregistrement : vérifiez la saisie et réessayez."
 
     valeurs = {}
-    if not brouillon.empty:
+    if erreur:
+        valeurs = {m: request.form.get(m, "") for m in mesures}  # La saisie refusée n'est pas perdue
+    elif not brouillon.empty:
         valeurs = brouillon.iloc[0].fillna("").to_dict()
     elif not valide.empty:
         n = len(valide) + 1
@@ -341,7 +2310,16 @@ def saisie(site):
 
     is_monday = today_date.weekday() == 0
     return render_template("saisie.html", site=site, mesures=mesures, valeurs=valeurs,
-                           valeurs_veille=valeurs_veille, valeurs_diff=valeurs_diff, is_monday=is_monday)
+                           valeurs_veille=valeurs_veille, valeurs_diff=valeurs_diff, is_monday=is_monday,
+                           synchro=etat_synchro(site), error=erreur)
+
+@app.route("/etat_synchro/<site>")
+@require_access(12)
+def etat_synchro_site(site):
+    """État de synchronisation d'un site, interrogé par les pages de saisie"""
+    if site not in sites:
+        return jsonify({"erreur": "Site inconnu"}), 404
+    return jsonify(etat_synchro(site))
 
 @app.route("/visualisation", methods=["GET", "POST"])
 @require_access(12)
@@ -356,116 +2334,126 @@ def visualisation():
         semaine = request.form.get("semaine")
         annee = request.form.get("annee")
 
-        # Générer une clé de cache unique pour ce graphique
-        cache_key = get_cache_key(site, parametre, semaine, annee, "visualisation")
-        
-        # Vérifier si le graphique est en cache
-        cached_image = load_from_cache(cache_key)
-        if cached_image:
-            plot_url = base64.b64encode(cached_image).decode()
-        else:
-            df = charger_donnees(site)
-            df["Date"] = pd.to_datetime(df["Date"], errors="coerce")
-            df = df.dropna(subset=["Date"])
-            df = df[df["Statut"] == "Validé"]
-            df = df.sort_values("Date")
-
-            # Filtrer par année si spécifiée, sinon utiliser l'année courante
-            if annee:
-                df = df[df["Date"].dt.year == int(annee)]
-            else:
-                current_year = datetime.now().year
-                df = df[df["Date"].dt.year == current_year]
-
-            # Filtrer par semaine si spécifiée
-            if semaine and parametre not in ["Coagulant", "Eau potable", "Floculant"]:
-                df["Semaine"] = df["Date"].dt.isocalendar().week
-                df = df[df["Semaine"] == int(semaine)]
-
-            if parametre in ["Coagulant", "Eau potable"]:
-                df = df[df["Date"].dt.weekday == 0]
-                df["Semaine"] = df["Date"].dt.isocalendar().week
-                semaines = df["Semaine"].tolist()
-                valeurs = pd.to_numeric(df[parametre], errors="coerce").fillna(0).tolist()
-                titre = f"{parametre} hebdomadaire ({site})"
-
-                plt.figure(figsize=(10, 5))
-                plt.plot(semaines, valeurs, marker="o")
-                plt.title(titre)
-                plt.xlabel("Semaine")
-                plt.ylabel(parametre)
-                plt.xticks(semaines, ["S" + str(s) for s in semaines])
-                plt.tight_layout()
-
-            elif parametre == "Floculant":
-                df["Semaine"] = df["Date"].dt.isocalendar().week
-                df[parametre] = pd.to_numeric(df[parametre], errors="coerce").fillna(0)
-                df_semaine = df.groupby("Semaine")[parametre].sum().reset_index()
-                semaines = df_semaine["Semaine"].tolist()
-                valeurs = df_semaine[parametre].tolist()
-                titre = f"Consommation hebdomadaire de {parametre} ({site})"
-
-                plt.figure(figsize=(10, 5))
-                plt.plot(semaines, valeurs, marker="o")
-                plt.title(titre)
-                plt.xlabel("Semaine")
-                plt.ylabel("Consommation")
-                plt.xticks(semaines, ["S" + str(s) for s in semaines])
-                plt.tight_layout()
-
-            elif parametre in parametres_compteurs.get(site, []):
-                df[parametre] = pd.to_numeric(df[parametre], errors='coerce').fillna(0)
-                df["Delta"] = df[parametre].diff().fillna(0)
-                dates = df["Date"].dt.date.tolist()
-                valeurs = df["Delta"].tolist()
-                titre = f"Variation journalière de {parametre} - {site}"
-
-                plt.figure(figsize=(10, 5))
-                plt.plot(dates, valeurs, marker="o")
-                plt.title(titre)
-                plt.xticks(rotation=45)
-                plt.tight_layout()
+        # Tracé dans le navigateur : seule la série est préparée, via /api/series
+        if request.form.get("navigateur"):
+            serie_url = url_for("api_series", site=site, parametre=parametre,
+                                annee=int(annee) if annee else datetime.now().year,
+                                semaine=semaine or None, page="visualisation")
+            return render_template("visualisation.html", sites=sites_list, mesures_par_site=mesures_par_site,
+                                   serie_url=serie_url, navigateur=True)
 
-            else:
-                dates = df["Date"].dt.date.tolist()
-                valeurs = pd.to_numeric(df[parametre], errors="coerce").fillna(0).tolist()
-                titre = f"Mesure de {parametre} - {site}"
-
-                plt.figure(figsize=(10, 5))
-                plt.plot(dates, valeurs, marker="o")
-                plt.title(titre)
-                plt.xticks(rotation=45)
-                plt.tight_layout()
-
-            img = io.BytesIO()
-            plt.savefig(img, format="png", dpi=100, bbox_inches='tight')
-            img.seek(0)
-            image_data = img.read()
-            
-            # Sauvegarder en cache
-            save_to_cache(cache_key, image_data)
-            
-            plot_url = base64.b64encode(image_data).decode()
-            plt.close()
+        # Le graphique est servi par /graphique : la page ne contient que son URL
+        plot_url = url_for("graphique", site=site, parametre=parametre,
+                           annee=int(annee) if annee else datetime.now().year,
+                           semaine=semaine or None, page="visualisation")
 
     return render_template("visualisation.html", 
                            sites=sites_list, 
                            mesures_par_site=mesures_par_site,
                            plot_url=plot_url)
 
+@app.route("/graphique/<site>/<path:parametre>")
+@require_access(12)
+def graphique(site, parametre):
+    """Image d'un graphique, avec ETag fort : un If-None-Match identique renvoie 304.
+
+    Paramètres : annee (année courante par défaut), semaine, page (visualisation ou
+    rapport) et format (png, svg ou webp)."""
+    page = request.args.get("page", "visualisation")
+    format_image = request.args.get("format", "png")
+    if site not in sites or parametre not in sites[site] or page not in PAGES_GRAPHIQUE \
+            or format_image not in FORMATS_IMAGE:
+        return "Graphique inconnu", 404
+    try:
+        annee = int(request.args["annee"]) if request.args.get("annee") else datetime.now().year
+        semaine = int(request.args["semaine"]) if request.args.get("semaine") else None
+    except ValueError:
+        return "Année ou semaine invalide", 400
+
+    image_data = image_graphique(site, parametre, annee, semaine, page, format_image)
+    reponse = app.response_class(image_data, mimetype=FORMATS_IMAGE[format_image]["mimetype"])
+    reponse.set_etag(hashlib.md5(image_data).hexdigest())
+    # Réservé à l'utilisateur connecté, revalidé à chaque affichage (304 si inchangé)
+    reponse.cache_control.private = True
+    reponse.cache_control.no_cache = True
+    return reponse.make_conditional(request)
+
+@app.route("/api/series")
+@require_access(12)
+def api_series():
+    """Série d'un graphique en JSON, pour le tracé dans le navigateur.
+
+    Paramètres : site, parametre, annee (année courante par défaut) ou debut/fin
+    (AAAA-MM-JJ), semaine (facultative), page (visualisation ou rapport, pour le titre),
+    points (nombre de points au plus, POINTS_MAX par défaut)."""
+    import pandas as pd
+    site = request.args.get("site")
+    parametre = request.args.get("parametre")
+    page = request.args.get("page", "visualisation")
+    if site not in sites or parametre not in sites[site] or page not in PAGES_GRAPHIQUE:
+        return jsonify({"erreur": "Site, paramètre ou page inconnu"}), 400
+    try:
+        annee = int(request.args["annee"]) if request.args.get("annee") else None
+        semaine = int(request.args["semaine"]) if request.args.get("semaine") else None
+        debut = pd.Timestamp(request.args["debut"]) if request.args.get("debut") else None
+        fin = pd.Timestamp(request.args["fin"]) if request.args.get("fin") else None
+        points = min(int(request.args.get("points") or POINTS_MAX), POINTS_MAX)
+    except ValueError:
+        return jsonify({"erreur": "Année, semaine, date ou nombre de points invalide"}), 400
+    if debut is not None and fin is not None and debut > fin:
+        return jsonify({"erreur": "La date de début est postérieure à la date de fin"}), 400
+
+    if annee is not None or (debut is None and fin is None):
+        annee = annee or datetime.now().year
+        annees = [annee]
+    else:
+        premiere = (debut or fin).year
+        derniere = fin.year if fin is not None else max(premiere, datetime.now().year)
+        annees = list(range(premiere, derniere + 1))
+    df = mesures_validees(site, annees)
+    abscisses, valeurs = series_graphique(df, site, parametre, annee, semaine, debut, fin)
+    abscisses, valeurs = reduire_serie(abscisses, valeurs, points)
+
+    type_graph = type_graphique(site, parametre)
+    spec = GRAPHIQUES[type_graph]
+    if spec["abscisse"] == "Date":
+        abscisses = pd.to_datetime(abscisses).dt.strftime("%Y-%m-%d")
+    periode = annee if annee else "-".join(str(a) for a in sorted({annees[0], annees[-1]}))
+    return jsonify({
+        "site": site,
+        "parametre": parametre,
+        "type": type_graph,
+        "titre": spec["titres"][page].format(site=site, parametre=parametre, annee=periode),
+        "abscisse": spec["abscisse"],
+        "x": abscisses.tolist(),
+        "y": valeurs.round(6).tolist(),
+    })
+
+def page_catalogue(catalogue, periodes):
+    """Page d'un catalogue selon les paramètres de la requête : avant ("annee-periode", curseur
+    exclu, page la plus récente sinon) et site (filtre facultatif)"""
+    site = request.args.get("site") or None
+    try:
+        avant = tuple(int(v) for v in request.args["avant"].split("-", 1))
+    except (KeyError, ValueError):
+        avant = None
+    entrees, suivant = catalogue.page(avant if avant and len(avant) == 2 else None, periodes, site)
+    return {"entrees": entrees, "suivant": "%d-%d" % suivant if suivant else None, "filtre_site": site}
+
 @app.route("/rapports")
 @require_access(14)
 def rapports_liste():
-    rapports = []
-    if os.path.exists(RAPPORTS_JSON):
-        with open(RAPPORTS_JSON, "r", encoding="utf-8") as f:
-            try:
-                rapports = json.load(f)
-            except Exception:
-                rapports = []
-    # Tri par année, semaine, site
-    rapports = sorted(rapports, key=lambda r: (r["annee"], r["semaine"], r["site"]))
-    return render_template("rapports.html", rapports=rapports)
+    # Semaines les plus récentes d'abord ; les suivantes sont chargées à la demande par /api/rapports
+    page = page_catalogue(catalogue_rapports, RAPPORTS_PAGE)
+    return render_template("rapports.html", rapports=page["entrees"], suivant=page["suivant"],
+                           filtre_site=page["filtre_site"], sites=list(sites.keys()))
+
+@app.route("/api/rapports")
+@require_access(14)
+def api_rapports():
+    """Page suivante de la bibliothèque des rapports, en JSON"""
+    page = page_catalogue(catalogue_rapports, RAPPORTS_PAGE)
+    return jsonify({"entrees": page["entrees"], "suivant": page["suivant"]})
 
 @app.route("/supprimer_rapport")
 @require_access(14)
@@ -475,164 +2463,198 @@ def supprimer_rapport():
     annee = request.args.get("annee")
     if not (site and semaine and annee):
         return redirect(url_for("rapport"))
-    # Charger et filtrer la bibliothèque
-    if os.path.exists(RAPPORTS_JSON):
-        with open(RAPPORTS_JSON, "r", encoding="utf-8") as f:
-            try:
-                rapports = json.load(f)
-            except Exception:
-                rapports = []
-        rapports = [r for r in rapports if not (str(r["site"]) == str(site) and str(r["semaine"]) == str(semaine) and str(r["annee"]) == str(annee))]
-        with open(RAPPORTS_JSON, "w", encoding="utf-8") as f:
-            json.dump(rapports, f, ensure_ascii=False, indent=2)
+    try:
+        catalogue_rapports.retirer(site, semaine, annee)
+    except ValueError:
+        pass  # Semaine ou année invalide : rien à retirer
     # (Optionnel) supprimer le cache associé
     # Rediriger vers la page rapport avec le site sélectionné
     return redirect(url_for("rapport", site=site))
 
 def enregistrer_releve(site, mois, annee, photos_paths):
-    """Enregistre un relevé photo dans le fichier JSON"""
-    releves = []
-    if os.path.exists(RELEVES_JSON):
-        with open(RELEVES_JSON, "r", encoding="utf-8") as f:
-            try:
-                releves = json.load(f)
-            except Exception:
-                releves = []
-    
-    # Vérifier si un relevé existe déjà pour ce site/mois/année
-    for r in releves:
-        if r["site"] == site and r["mois"] == mois and r["annee"] == annee:
-            return False  # Relevé déjà existant
-    
-    releves.append({
+    """Inscrit un relevé photo ; renvoie False si un relevé existe déjà pour ce site/mois/année"""
+    return catalogue_releves.ajouter({
         "site": site,
         "mois": mois,
         "annee": annee,
         "photos": photos_paths,
         "timestamp": datetime.now().isoformat()
     })
-    
-    with open(RELEVES_JSON, "w", encoding="utf-8") as f:
-        json.dump(releves, f, ensure_ascii=False, indent=2)
-    return True
 
-def charger_releves():
-    """Charge tous les relevés depuis le fichier JSON"""
-    if os.path.exists(RELEVES_JSON):
-        with open(RELEVES_JSON, "r", encoding="utf-8") as f:
-            try:
-                return json.load(f)
-            except Exception:
-                return []
-    return []
-
-def sauvegarder_photo(photo_file, site, debitmetre, mois, annee):
-    """Sauvegarde une photo avec un nom unique dans un sous-dossier spécifique au relevé"""
-    if photo_file:
+# --- Photos des relevés ---
+# Chaque photo reçue est redressée selon son orientation EXIF, réduite à PHOTO_COTE_MAX
+# et ré-encodée en JPEG d'au plus PHOTO_OCTETS_MAX (environ), puis déclinée en miniatures
+# de largeurs fixes (nom_320.jpg, nom_960.jpg) servies par /miniature.
+
+def chemin_miniature(chemin, largeur):
+    """Chemin de la miniature d'une photo (relatif ou absolu, comme celui de la photo)"""
+    return f"{os.path.splitext(chemin)[0]}_{largeur}.jpg"
+
+def ecrire_jpeg(img, chemin, qualite, octets_max=None):
+    """Écrit atomiquement une image en JPEG, en baissant la qualité jusqu'à tenir dans octets_max"""
+    while True:
+        tampon = io.BytesIO()
+        img.save(tampon, "JPEG", quality=qualite, optimize=True, progressive=True)
+        if octets_max is None or tampon.tell() <= octets_max or qualite <= 45:
+            break
+        qualite -= 10
+    tmp = f"{chemin}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(tampon.getvalue())
+    os.replace(tmp, chemin)
+
+def ecrire_miniatures(img, chemin):
+    """Écrit les miniatures d'une image à côté de sa photo"""
+    from PIL import Image
+    for largeur in MINIATURES_LARGEURS:
+        if img.width > largeur:
+            miniature = img.resize((largeur, max(1, round(img.height * largeur / img.width))),
+                                   Image.LANCZOS, reducing_gap=2.0)
+        else:
+            miniature = img
+        ecrire_jpeg(miniature, chemin_miniature(chemin, largeur), MINIATURE_QUALITE)
+
+def preparer_photo(source, chemin):
+    """Enregistre en `chemin` une photo redressée, réduite et ré-encodée, avec ses miniatures.
+
+    `source` est un chemin ou un flux ; une source qui n'est pas une image lisible lève
+    une exception."""
+    from PIL import Image, ImageOps
+    with Image.open(source) as img:
+        # Décodage JPEG directement à l'échelle utile (1/2, 1/4, 1/8)
+        img.draft("RGB", (PHOTO_COTE_MAX, PHOTO_COTE_MAX))
+        img = ImageOps.exif_transpose(img).convert("RGB")
+    img.thumbnail((PHOTO_COTE_MAX, PHOTO_COTE_MAX), Image.LANCZOS, reducing_gap=3.0)
+    ecrire_jpeg(img, chemin, PHOTO_QUALITE, PHOTO_OCTETS_MAX)
+    ecrire_miniatures(img, chemin)
+
+def fichiers_photo(filename):
+    """Fichiers (relatifs à PHOTOS_DIR) d'une photo : la photo puis ses miniatures"""
+    return [filename] + [chemin_miniature(filename, largeur) for largeur in MINIATURES_LARGEURS]
+
+class RequeteFichiersDisque(Request):
+    """Requête dont les fichiers envoyés sont écrits sur disque au fil de la réception,
+    plutôt que gardés en mémoire jusqu'à 500 Ko"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        os.makedirs(PHOTOS_RECEPTION, exist_ok=True)
+        return tempfile.TemporaryFile(dir=PHOTOS_RECEPTION)
+
+app.request_class = RequeteFichiersDisque
+
+_pool_photos = None
+_verrou_pool_photos = threading.Lock()
+
+def get_pool_photos():
+    """Pool de threads de traitement des photos, créé à la première demande"""
+    global _pool_photos
+    with _verrou_pool_photos:
+        if _pool_photos is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _pool_photos = ThreadPoolExecutor(max_workers=PHOTOS_TRAVAILLEURS, thread_name_prefix="photos")
+        return _pool_photos
+
+def traiter_photo(photo_file, dossier, debitmetre):
+    """Prépare une photo reçue dans le dossier de son relevé ; renvoie son chemin relatif à PHOTOS_DIR"""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = os.path.join(dossier, f"{debitmetre.replace(' ', '_')}_{timestamp}.jpg")
+    preparer_photo(photo_file.stream, os.path.join(PHOTOS_DIR, filename))
+    return filename
+
+def supprimer_photos(photos, dossier):
+    """Supprime des photos (chemins relatifs à PHOTOS_DIR), leurs miniatures et leur dossier s'il est vide"""
+    dossier_path = os.path.join(PHOTOS_DIR, dossier)
+    try:
+        for filename in photos:
+            for fichier in fichiers_photo(filename):
+                photo_path = os.path.join(PHOTOS_DIR, fichier)
+                if os.path.exists(photo_path):
+                    os.remove(photo_path)
+                    print(f"Photo supprimée : {photo_path}")
+        if os.path.isdir(dossier_path) and not os.listdir(dossier_path):
+            os.rmdir(dossier_path)
+            print(f"Dossier supprimé : {dossier_path}")
+    except Exception as e:
+        print(f"Erreur lors de la suppression des fichiers/dossier : {e}")
+
+def traiter_photos_releve(site, mois, annee, fichiers):
+    """Traite en parallèle les photos d'un relevé ({débitmètre: fichier reçu}) puis l'inscrit.
+
+    Le relevé n'est inscrit qu'une fois toutes ses photos traitées avec succès ; sinon
+    les photos déjà écrites sont supprimées. Renvoie (statut par débitmètre, inscrit)."""
+    dossier = f"{site.replace(' ', '_')}_{mois}_{annee}"
+    os.makedirs(os.path.join(PHOTOS_DIR, dossier), mode=0o755, exist_ok=True)
+    pool = get_pool_photos()
+    taches = {debitmetre: pool.submit(traiter_photo, photo_file, dossier, debitmetre)
+              for debitmetre, photo_file in fichiers.items()}
+    photos_paths, statuts = {}, {}
+    for debitmetre, tache in taches.items():
         try:
-            # S'assurer que le dossier principal existe avec les bonnes permissions
-            if not os.path.exists(PHOTOS_DIR):
-                os.makedirs(PHOTOS_DIR, mode=0o755)
-                print(f"Dossier principal créé: {PHOTOS_DIR}")
-            
-            # Créer le nom du sous-dossier au format site_mois_année
-            subfolder_name = f"{site.replace(' ', '_')}_{mois}_{annee}"
-            subfolder_path = os.path.join(PHOTOS_DIR, subfolder_name)
-            print(f"Tentative de création du sous-dossier: {subfolder_path}")
-            
-            # Créer le sous-dossier s'il n'existe pas
-            if not os.path.exists(subfolder_path):
-                os.makedirs(subfolder_path, mode=0o755)
-                print(f"Sous-dossier créé: {subfolder_path}")
-            
-            # Créer le nom de fichier unique
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"{debitmetre.replace(' ', '_')}_{timestamp}.jpg"
-            filepath = os.path.join(subfolder_path, filename)
-            print(f"Tentative de sauvegarde de la photo: {filepath}")
-            
-            # Sauvegarder la photo
-            photo_file.save(filepath)
-            print(f"Photo sauvegardée avec succès: {filepath}")
-            
-            # Vérifier que le fichier a bien été créé
-            if not os.path.exists(filepath):
-                raise Exception(f"Le fichier n'a pas été créé: {filepath}")
-            
-            # Retourner le chemin relatif par rapport à PHOTOS_DIR
-            relative_path = os.path.join(subfolder_name, filename)
-            print(f"Chemin relatif retourné: {relative_path}")
-            return relative_path
-            
+            photos_paths[debitmetre] = tache.result()
+            statuts[debitmetre] = {"ok": True, "message": "Photo enregistrée"}
         except Exception as e:
-            print(f"Erreur lors de la sauvegarde de la photo: {str(e)}")
-            # En cas d'erreur, on essaie de sauvegarder directement dans le dossier principal
-            try:
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                filename = f"{site.replace(' ', '_')}_{debitmetre.replace(' ', '_')}_{mois}_{annee}_{timestamp}.jpg"
-                filepath = os.path.join(PHOTOS_DIR, filename)
-                photo_file.save(filepath)
-                print(f"Photo sauvegardée en fallback: {filepath}")
-                return filename
-            except Exception as e2:
-                print(f"Erreur également lors de la sauvegarde de secours: {str(e2)}")
-                return None
-    return None
+            print(f"Erreur lors du traitement de la photo {debitmetre} ({fichiers[debitmetre].filename}): {e}")
+            statuts[debitmetre] = {"ok": False, "message": "Image illisible ou impossible à enregistrer"}
+    inscrit = len(photos_paths) == len(fichiers) and enregistrer_releve(site, mois, annee, photos_paths)
+    if not inscrit:
+        supprimer_photos(photos_paths.values(), dossier)
+    return statuts, inscrit
+
+def historique_releves():
+    """Page de l'historique des relevés, des mois les plus récents aux plus anciens"""
+    page = page_catalogue(catalogue_releves, RELEVES_PAGE)
+    return {"releves": page["entrees"], "suivant": page["suivant"], "filtre_site": page["filtre_site"]}
+
+@app.route("/api/releves")
+@require_access(13)
+def api_releves():
+    """Page suivante de l'historique des relevés, en JSON"""
+    page = page_catalogue(catalogue_releves, RELEVES_PAGE)
+    return jsonify({"entrees": page["entrees"], "suivant": page["suivant"]})
 
 @app.route("/releve_20", methods=["GET", "POST"])
 @require_access(13)
 def releve_20():
     sites_list = list(debitmetres.keys())
-    releves = charger_releves()
-    # Trier par date (plus récent en premier)
-    releves = sorted(releves, key=lambda r: (r["annee"], r["mois"]), reverse=True)
     
     if request.method == "POST":
         site = request.form["site"]
         mois = int(request.form["mois"])
         annee = int(request.form["annee"])
+        if site not in debitmetres:
+            return render_template("releve_20.html", sites=sites_list, debitmetres=debitmetres, 
+                                 error="Site inconnu", **historique_releves())
         
-        # Traitement des photos uploadées
-        photos_paths = {}
+        # Photos reçues (déjà sur disque) : sélection de fichier ou photo caméra
+        fichiers = {}
         for debitmetre in debitmetres[site]:
-            # Vérifier les deux possibilités : fichier ou photo caméra
             photo_key = f"photo_{debitmetre.replace(' ', '_')}"
-            photo_key_camera = f"{photo_key}_camera"
-            
-            photo_file = None
-            if photo_key in request.files:
-                photo_file = request.files[photo_key]
-            elif photo_key_camera in request.files:
-                photo_file = request.files[photo_key_camera]
-            
-            if photo_file and photo_file.filename:
-                print(f"Traitement de la photo pour {debitmetre}: {photo_file.filename}")
-                filename = sauvegarder_photo(photo_file, site, debitmetre, mois, annee)
-                if filename:
-                    photos_paths[debitmetre] = filename
-                    print(f"Photo sauvegardée: {filename}")
+            for cle in (f"{photo_key}_file", photo_key, f"{photo_key}_camera"):
+                photo_file = request.files.get(cle)
+                if photo_file and photo_file.filename:
+                    fichiers[debitmetre] = photo_file
+                    break
         
-        # Enregistrer le relevé
-        if photos_paths:
-            print(f"Tentative d'enregistrement du relevé avec {len(photos_paths)} photos")
-            success = enregistrer_releve(site, mois, annee, photos_paths)
-            if success:
-                print("Relevé enregistré avec succès")
-                # Recharger les relevés après ajout
-                releves = charger_releves()
-                releves = sorted(releves, key=lambda r: (r["annee"], r["mois"]), reverse=True)
-                return render_template("releve_20.html", sites=sites_list, debitmetres=debitmetres, 
-                                     releves=releves, selected_site=site, just_saved=True, mois=mois, annee=annee)
-            else:
-                print("Erreur: Un relevé existe déjà")
-                return render_template("releve_20.html", sites=sites_list, debitmetres=debitmetres, 
-                                     releves=releves, error="Un relevé existe déjà pour ce site/mois/année")
-        else:
-            print("Erreur: Aucune photo n'a été uploadée")
+        if not fichiers:
+            return render_template("releve_20.html", sites=sites_list, debitmetres=debitmetres, 
+                                 error="Veuillez sélectionner au moins une photo", **historique_releves())
+        if catalogue_releves.get(site, mois, annee):
             return render_template("releve_20.html", sites=sites_list, debitmetres=debitmetres, 
-                                 releves=releves, error="Veuillez sélectionner au moins une photo")
+                                 error="Un relevé existe déjà pour ce site/mois/année", **historique_releves())
+        
+        # Traitement parallèle des photos, puis inscription du relevé complet
+        statuts, inscrit = traiter_photos_releve(site, mois, annee, fichiers)
+        if inscrit:
+            return render_template("releve_20.html", sites=sites_list, debitmetres=debitmetres, statuts=statuts,
+                                 selected_site=site, just_saved=True, mois=mois, annee=annee, **historique_releves())
+        if all(statut["ok"] for statut in statuts.values()):
+            error = "Un relevé existe déjà pour ce site/mois/année"
+        else:
+            error = "Certaines photos n'ont pas pu être traitées : le relevé n'a pas été enregistré"
+        return render_template("releve_20.html", sites=sites_list, debitmetres=debitmetres, statuts=statuts,
+                             selected_site=site, mois=mois, annee=annee, error=error, **historique_releves())
     
-    return render_template("releve_20.html", sites=sites_list, debitmetres=debitmetres, releves=releves)
+    return render_template("releve_20.html", sites=sites_list, debitmetres=debitmetres, **historique_releves())
 
 @app.route("/supprimer_releve")
 @require_access(13)
@@ -643,44 +2665,15 @@ def supprimer_releve():
     if not (site and mois and annee):
         return redirect(url_for("releve_20"))
     
-    # Charger et filtrer les relevés
-    releves = charger_releves()
-    
-    # Trouver le relevé à supprimer pour récupérer les noms des fichiers photos
-    releve_a_supprimer = None
-    for r in releves:
-        if str(r["site"]) == str(site) and str(r["mois"]) == str(mois) and str(r["annee"]) == str(annee):
-            releve_a_supprimer = r
-            break
+    # Retirer le relevé du catalogue en récupérant les noms des fichiers photos
+    try:
+        releve_a_supprimer = catalogue_releves.retirer(site, mois, annee)
+    except ValueError:
+        releve_a_supprimer = None  # Mois ou année invalide
     
     # Supprimer les fichiers photos et le dossier
     if releve_a_supprimer and "photos" in releve_a_supprimer:
-        # Identifier le dossier du relevé
-        subfolder_name = f"{site.replace(' ', '_')}_{mois}_{annee}"
-        subfolder_path = os.path.join(PHOTOS_DIR, subfolder_name)
-        
-        try:
-            # Supprimer d'abord les fichiers
-            for debitmetre, filename in releve_a_supprimer["photos"].items():
-                photo_path = os.path.join(PHOTOS_DIR, filename)
-                if os.path.exists(photo_path):
-                    os.remove(photo_path)
-                    print(f"Photo supprimée : {photo_path}")
-            
-            # Supprimer le dossier s'il est vide
-            if os.path.exists(subfolder_path):
-                if not os.listdir(subfolder_path):  # Vérifier si le dossier est vide
-                    os.rmdir(subfolder_path)
-                    print(f"Dossier supprimé : {subfolder_path}")
-        except Exception as e:
-            print(f"Erreur lors de la suppression des fichiers/dossier : {e}")
-    
-    # Filtrer le relevé de la liste
-    releves = [r for r in releves if not (str(r["site"]) == str(site) and str(r["mois"]) == str(mois) and str(r["annee"]) == str(annee))]
-    
-    # Sauvegarder la liste mise à jour
-    with open(RELEVES_JSON, "w", encoding="utf-8") as f:
-        json.dump(releves, f, ensure_ascii=False, indent=2)
+        supprimer_photos(releve_a_supprimer["photos"].values(), f"{site.replace(' ', '_')}_{mois}_{annee}")
     
     return redirect(url_for("releve_20"))
 
@@ -694,8 +2687,10 @@ def voir_photos():
         return redirect(url_for("releve_20"))
     
     # Trouver le relevé correspondant
-    releves = charger_releves()
-    releve = next((r for r in releves if str(r["site"]) == str(site) and str(r["mois"]) == str(mois) and str(r["annee"]) == str(annee)), None)
+    try:
+        releve = catalogue_releves.get(site, mois, annee)
+    except ValueError:
+        releve = None
     
     if releve:
         return render_template("voir_photos.html", releve=releve, site=site, mois=mois, annee=annee)
@@ -708,37 +2703,39 @@ def serve_photo(filename):
     # La fonction send_from_directory gère automatiquement les sous-dossiers avec le type path
     return send_from_directory(PHOTOS_DIR, filename)
 
+@app.route("/miniature/<int:largeur>/<path:filename>")
+@require_access(13)
+def miniature(largeur, filename):
+    """Miniature d'une photo ; créée à la demande pour les photos enregistrées avant les miniatures"""
+    if largeur not in MINIATURES_LARGEURS:
+        return "Largeur de miniature inconnue", 404
+    nom = chemin_miniature(filename, largeur)
+    source = safe_join(PHOTOS_DIR, filename)
+    chemin = safe_join(PHOTOS_DIR, nom)
+    if source is None or chemin is None:
+        return "Fichier non trouvé", 404
+    if not os.path.exists(chemin):
+        if not os.path.isfile(source):
+            return "Fichier non trouvé", 404
+        try:
+            from PIL import Image, ImageOps
+            with Image.open(source) as img:
+                img.draft("RGB", (max(MINIATURES_LARGEURS), max(MINIATURES_LARGEURS)))
+                ecrire_miniatures(ImageOps.exif_transpose(img).convert("RGB"), source)
+        except Exception as e:
+            print(f"Erreur lors de la création des miniatures de {filename}: {e}")
+            return "Miniature indisponible", 404
+    return send_from_directory(PHOTOS_DIR, nom)
+
 @app.route("/rapport", methods=["GET", "POST"])
 @require_access(14)
 def rapport():
     try:
         sites_list = list(sites.keys())
         rapports = []
-        all_rapports = []
         
-        # Charger les rapports existants
-        if os.path.exists(RAPPORTS_JSON):
-            with open(RAPPORTS_JSON, "r", encoding="utf-8") as f:
-                try:
-                    all_rapports = json.load(f)
-                except Exception as e:
-                    print(f"Erreur lors de la lecture des rapports: {str(e)}")
-                    all_rapports = []
-
-        # Construction de la table croisée année/semaine/sites
-        index = set()
-        for r in all_rapports:
-            index.add((int(r["annee"]), int(r["semaine"])))
-        index = sorted(index, reverse=True)
-        
-        # Pour chaque (année, semaine), on regarde si un rapport existe pour chaque site
-        table_rapports = []
-        for annee, semaine in index:
-            ligne = {"annee": annee, "semaine": semaine}
-            for site in sites_list:
-                found = next((r for r in all_rapports if int(r["annee"]) == annee and int(r["semaine"]) == semaine and r["site"] == site), None)
-                ligne[site] = found
-            table_rapports.append(ligne)
+        # Table croisée année/semaine/sites de la bibliothèque, une année par page
+        table = page_table_rapports(sites_list, request.args.get("annee_table", type=int))
 
         # Affichage d'un rapport existant via GET
         if request.method == "GET" and "semaine" in request.args and "annee" in request.args and "site" in request.args:
@@ -751,73 +2748,24 @@ def rapport():
                     print(f"Site invalide: {site}")
                     return redirect(url_for("rapport"))
                 
-                rapports_result = []
-                df = charger_donnees(site)
-                
-                if df is not None and not df.empty:
-                    df["Date"] = pd.to_datetime(df["Date"], errors="coerce")
-                    df = df[df["Statut"] == "Validé"]
-                    df["Annee"] = df["Date"].dt.year
-                    df["Semaine"] = df["Date"].dt.isocalendar().week
-                    
-                    for parametre in sites[site]:
-                        cache_key = get_cache_key(site, parametre, semaine, annee, "rapport")
-                        cached_image = load_from_cache(cache_key)
-                        if cached_image:
-                            plot_url = base64.b64encode(cached_image).decode()
-                            rapports_result.append({"site": site, "parametre": parametre, "plot": plot_url})
-                            continue
-                        
-                        # Si pas en cache, on régénère le graphique
-                        img = io.BytesIO()
-                        plt.figure(figsize=(8, 4))
-                        
-                        if parametre in ["Coagulant", "Eau potable"]:
-                            df_annuel = df[(df["Date"].dt.year == datetime.now().year) & (df["Date"].dt.weekday == 0)]
-                            df_annuel["Semaine"] = df_annuel["Date"].dt.isocalendar().week
-                            valeurs = pd.to_numeric(df_annuel[parametre], errors="coerce").fillna(0)
-                            semaines = df_annuel["Semaine"]
-                            plt.plot(semaines, valeurs, marker="o")
-                            plt.title(f"{site} - {parametre} (année en cours)")
-                            plt.xlabel("Semaine")
-                            plt.xticks(semaines, ["S" + str(s) for s in semaines])
-                        elif parametre == "Floculant":
-                            df_floc = df[df["Date"].dt.year == datetime.now().year]
-                            df_floc["Semaine"] = df_floc["Date"].dt.isocalendar().week
-                            df_floc[parametre] = pd.to_numeric(df_floc[parametre], errors="coerce").fillna(0)
-                            df_floc = df_floc.groupby("Semaine")[parametre].sum().reset_index()
-                            plt.plot(df_floc["Semaine"], df_floc[parametre], marker="o")
-                            plt.title(f"{site} - Floculant hebdo (année en cours)")
-                            plt.xlabel("Semaine")
-                            plt.xticks(df_floc["Semaine"], ["S" + str(s) for s in df_floc["Semaine"]])
-                        elif parametre in parametres_compteurs[site]:
-                            df_semaine = df[(df["Annee"] == annee) & (df["Semaine"] == semaine)]
-                            valeurs = pd.to_numeric(df_semaine[parametre], errors="coerce").fillna(0).diff().fillna(0)
-                            dates = df_semaine["Date"].dt.date
-                            plt.plot(dates, valeurs, marker="o")
-                            plt.title(f"{site} - Delta {parametre}")
-                            plt.xticks(rotation=45)
-                        elif parametre in parametres_directs[site]:
-                            df_semaine = df[(df["Annee"] == annee) & (df["Semaine"] == semaine)]
-                            valeurs = pd.to_numeric(df_semaine[parametre], errors="coerce").fillna(0)
-                            dates = df_semaine["Date"].dt.date
-                            plt.plot(dates, valeurs, marker="o")
-                            plt.title(f"{site} - {parametre}")
-                            plt.xticks(rotation=45)
-                        else:
-                            plt.close()
-                            continue
-                            
-                        plt.tight_layout()
-                        plt.savefig(img, format="png", dpi=100, bbox_inches='tight')
-                        img.seek(0)
-                        image_data = img.read()
-                        save_to_cache(cache_key, image_data)
-                        plot_url = base64.b64encode(image_data).decode()
-                        plt.close()
-                        rapports_result.append({"site": site, "parametre": parametre, "plot": plot_url})
+                navigateur = request.args.get("navigateur") == "1"
+                format_image = request.args.get("format", "png")
+                if format_image not in FORMATS_IMAGE:
+                    format_image = "png"
+                if navigateur:
+                    # Tracé dans le navigateur : pas de rendu d'image côté serveur
+                    rapports_result = [{"site": site, "parametre": parametre,
+                                        "serie": url_for("api_series", site=site, parametre=parametre, annee=annee,
+                                                         semaine=semaine, page="rapport")}
+                                       for parametre in sites[site]]
+                else:
+                    rapports_result = [{"site": site, "parametre": parametre,
+                                        "url": url_for("graphique", site=site, parametre=parametre, annee=annee,
+                                                       semaine=semaine, page="rapport", format=format_image)}
+                                       for parametre in graphiques_rapport(site, semaine, annee, format_image)]
                 
-                return render_template("rapport_resultat.html", rapports=rapports_result, semaine=semaine, annee=annee)
+                return render_template("rapport_resultat.html", rapports=rapports_result, semaine=semaine, annee=annee,
+                                       site=site, navigateur=navigateur, format_image=format_image)
             except Exception as e:
                 print(f"Erreur lors de la génération du rapport GET: {str(e)}")
                 return redirect(url_for("rapport"))
@@ -833,104 +2781,59 @@ def rapport():
                     print(f"Site invalide: {site}")
                     return redirect(url_for("rapport"))
                 
-                rapports_result = []
-                df = charger_donnees(site)
+                rapports_result = graphiques_rapport(site, semaine, annee)
                 
-                if df is not None and not df.empty:
-                    df["Date"] = pd.to_datetime(df["Date"], errors="coerce")
-                    df = df[df["Statut"] == "Validé"]
-                    df["Annee"] = df["Date"].dt.year
-                    df["Semaine"] = df["Date"].dt.isocalendar().week
-                    
-                    for parametre in sites[site]:
-                        cache_key = get_cache_key(site, parametre, semaine, annee, "rapport")
-                        cached_image = load_from_cache(cache_key)
-                        if cached_image:
-                            plot_url = base64.b64encode(cached_image).decode()
-                            rapports_result.append({"site": site, "parametre": parametre, "plot": plot_url})
-                            continue
-                        
-                        img = io.BytesIO()
-                        plt.figure(figsize=(8, 4))
-                        
-                        if parametre in ["Coagulant", "Eau potable"]:
-                            df_annuel = df[(df["Date"].dt.year == datetime.now().year) & (df["Date"].dt.weekday == 0)]
-                            df_annuel["Semaine"] = df_annuel["Date"].dt.isocalendar().week
-                            valeurs = pd.to_numeric(df_annuel[parametre], errors="coerce").fillna(0)
-                            semaines = df_annuel["Semaine"]
-                            plt.plot(semaines, valeurs, marker="o")
-                            plt.title(f"{site} - {parametre} (année en cours)")
-                            plt.xlabel("Semaine")
-                            plt.xticks(semaines, ["S" + str(s) for s in semaines])
-                        elif parametre == "Floculant":
-                            df_floc = df[df["Date"].dt.year == datetime.now().year]
-                            df_floc["Semaine"] = df_floc["Date"].dt.isocalendar().week
-                            df_floc[parametre] = pd.to_numeric(df_floc[parametre], errors="coerce").fillna(0)
-                            df_floc = df_floc.groupby("Semaine")[parametre].sum().reset_index()
-                            plt.plot(df_floc["Semaine"], df_floc[parametre], marker="o")
-                            plt.title(f"{site} - Floculant hebdo (année en cours)")
-                            plt.xlabel("Semaine")
-                            plt.xticks(df_floc["Semaine"], ["S" + str(s) for s in df_floc["Semaine"]])
-                        elif parametre in parametres_compteurs[site]:
-                            df_semaine = df[(df["Annee"] == annee) & (df["Semaine"] == semaine)]
-                            valeurs = pd.to_numeric(df_semaine[parametre], errors="coerce").fillna(0).diff().fillna(0)
-                            dates = df_semaine["Date"].dt.date
-                            plt.plot(dates, valeurs, marker="o")
-                            plt.title(f"{site} - Delta {parametre}")
-                            plt.xticks(rotation=45)
-                        elif parametre in parametres_directs[site]:
-                            df_semaine = df[(df["Annee"] == annee) & (df["Semaine"] == semaine)]
-                            valeurs = pd.to_numeric(df_semaine[parametre], errors="coerce").fillna(0)
-                            dates = df_semaine["Date"].dt.date
-                            plt.plot(dates, valeurs, marker="o")
-                            plt.title(f"{site} - {parametre}")
-                            plt.xticks(rotation=45)
-                        else:
-                            plt.close()
-                            continue
-                            
-                        plt.tight_layout()
-                        plt.savefig(img, format="png", dpi=100, bbox_inches='tight')
-                        img.seek(0)
-                        image_data = img.read()
-                        save_to_cache(cache_key, image_data)
-                        plot_url = base64.b64encode(image_data).decode()
-                        plt.close()
-                        rapports_result.append({"site": site, "parametre": parametre, "plot": plot_url})
+                if rapports_result:
                     
                     enregistrer_rapport(semaine, annee, site)
                     
-                    # Après génération, recharger la table croisée
-                    if os.path.exists(RAPPORTS_JSON):
-                        with open(RAPPORTS_JSON, "r", encoding="utf-8") as f:
-                            try:
-                                all_rapports = json.load(f)
-                            except Exception:
-                                all_rapports = []
-                        index = set()
-                        for r in all_rapports:
-                            index.add((int(r["annee"]), int(r["semaine"])))
-                        index = sorted(index, reverse=True)
-                        table_rapports = []
-                        for annee_, semaine_ in index:
-                            ligne = {"annee": annee_, "semaine": semaine_}
-                            for site_ in sites_list:
-                                found = next((r for r in all_rapports if int(r["annee"]) == annee_ and int(r["semaine"]) == semaine_ and r["site"] == site_), None)
-                                ligne[site_] = found
-                            table_rapports.append(ligne)
+                    # Après génération, afficher l'année du rapport dans la table croisée
+                    table = page_table_rapports(sites_list, annee)
                 
-                return render_template("rapport_form.html", table_rapports=table_rapports, sites=sites_list, just_generated=True, semaine=semaine, annee=annee)
+                return render_template("rapport_form.html", sites=sites_list, just_generated=True, semaine=semaine, annee=annee, **table)
             except Exception as e:
                 print(f"Erreur lors de la génération du rapport POST: {str(e)}")
-                return render_template("rapport_form.html", table_rapports=table_rapports, sites=sites_list, error="Une erreur est survenue lors de la génération du rapport.")
+                return render_template("rapport_form.html", sites=sites_list, error="Une erreur est survenue lors de la génération du rapport.", **table)
         
         # Affichage du formulaire par défaut
-        return render_template("rapport_form.html", table_rapports=table_rapports, sites=sites_list)
+        return render_template("rapport_form.html", sites=sites_list, **table)
         
     except Exception as e:
         print(f"Erreur générale dans la route /rapport: {str(e)}")
         return render_template("rapport_form.html", sites=sites_list, error="Une erreur est survenue lors du chargement de la page.")
 
+@app.route("/rapport_pdf")
+@app.route("/rapport_zip")
+@require_access(14)
+def rapport_export():
+    """Export en flux d'un rapport en PDF ou en ZIP de graphiques.
+
+    Paramètres : site (répétable), annee, semaine et, pour plusieurs semaines,
+    annee_fin et semaine_fin."""
+    try:
+        sites_export = [site for site in request.args.getlist("site") if site in sites]
+        annee = int(request.args["annee"])
+        semaine = int(request.args["semaine"])
+        annee_fin = int(request.args.get("annee_fin") or annee)
+        semaine_fin = int(request.args.get("semaine_fin") or semaine)
+        semaines = semaines_export(annee, semaine, annee_fin, semaine_fin)
+    except (KeyError, ValueError) as e:
+        print(f"Paramètres d'export invalides: {e}")
+        return redirect(url_for("rapport"))
+    if not sites_export or not semaines:
+        return redirect(url_for("rapport"))
+
+    nom = f"rapport_{'_'.join(sites_export)}_{annee}-S{semaine:02d}"
+    if semaines[-1] != (annee, semaine):
+        nom += f"_{semaines[-1][0]}-S{semaines[-1][1]:02d}"
+    images = images_export(sites_export, semaines)
+    if request.path == "/rapport_zip":
+        flux, mimetype, nom = flux_zip(images), "application/zip", nom + ".zip"
+    else:
+        flux, mimetype, nom = flux_pdf(images), "application/pdf", nom + ".pdf"
+    return app.response_class(stream_with_context(flux), mimetype=mimetype,
+                              headers={"Content-Disposition": f'attachment; filename="{nom}"'})
+
 @app.route('/telecharger_mesures')
 @require_access(14)
 def telecharger_mesures():
@@ -942,19 +2845,38 @@ def telecharger_mesures():
         return "Fichier non trouvé", 404
 
 def test_google_sheets():
-    print(">>> test_google_sheets démarre")
-    SERVICE_ACCOUNT_FILE = r'C:\monprojet\releves-ste-d4d0922bacfa.json'
-    SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
-    creds = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-    gc = gspread.authorize(creds)
-    sh = gc.open_by_url("https://docs.google.com/spreadsheets/d/1dx1TNiG-LVU_DrjNjWkQJStvrFbJPfiwXia2owW40zA/edit")
-    worksheet = sh.sheet1
-    data = worksheet.get_all_values()
-    print("Lecture réussie ! Première ligne :", data[0])
-    worksheet.update('A2', [['Test écriture depuis Python !']])
-    print("Écriture réussie !")
-
-test_google_sheets()
+    """Vérifie l'accès au stockage distant en lisant l'en-tête de chaque onglet (aucune écriture)"""
+    debut = time.perf_counter()
+    onglets = get_stockage().lire_onglets(list(sites))
+    return {
+        "stockage": type(get_stockage()).__name__,
+        "onglets": {nom: (lignes[0] if lignes else []) for nom, lignes in onglets.items()},
+        "duree_ms": round((time.perf_counter() - debut) * 1000),
+    }
+
+@app.route("/sante")
+def sante():
+    """Vérification légère pour l'hébergeur : aucun appel réseau"""
+    return jsonify({
+        "statut": "ok",
+        "demarrage_ms": DUREE_DEMARRAGE_MS,
+        "synchro_demarree": bool(_threads_synchro),
+        "quota_gsheet": stats_gsheet,
+        "cache_graphiques": statistiques_cache(),
+        "planification": etat_planification,
+    })
+
+@app.route("/sante/stockage")
+@require_access(14)
+def sante_stockage():
+    """Vérification explicite de l'accès au stockage distant"""
+    try:
+        return jsonify({"statut": "ok", **test_google_sheets()})
+    except Exception as e:
+        return jsonify({"statut": "erreur", "erreur": str(e)}), 503
+
+DUREE_DEMARRAGE_MS = round((time.perf_counter() - _debut_demarrage) * 1000)
+print(f"Application chargée en {DUREE_DEMARRAGE_MS} ms")
 
 if __name__ == "__main__":
     # Nettoyer le cache expiré au démarrage
@@ -0,0 +1,119 @@
+// Tracé des séries de /api/series dans le navigateur (SVG, sans bibliothèque externe).
+// Usage : <div class="graphique-navigateur" data-serie="/api/series?..."></div>
+
+(function () {
+    const SVG = "http://www.w3.org/2000/svg";
+    const LARGEUR = 800, HAUTEUR = 400;
+    const MARGES = {haut: 36, droite: 16, bas: 70, gauche: 56};
+
+    function element(nom, attributs, parent) {
+        const el = document.createElementNS(SVG, nom);
+        for (const cle in attributs) {
+            el.setAttribute(cle, attributs[cle]);
+        }
+        if (parent) {
+            parent.appendChild(el);
+        }
+        return el;
+    }
+
+    function texte(contenu, attributs, parent) {
+        const el = element("text", attributs, parent);
+        el.textContent = contenu;
+        return el;
+    }
+
+    function graduations(min, max, nombre) {
+        if (min === max) {
+            return [min];
+        }
+        const pas = (max - min) / (nombre - 1);
+        return Array.from({length: nombre}, (_, i) => min + i * pas);
+    }
+
+    function format(valeur) {
+        return Math.abs(valeur) >= 100 ? valeur.toFixed(0) : Number(valeur.toPrecision(3)).toString();
+    }
+
+    function tracer(conteneur, serie) {
+        const largeur = LARGEUR - MARGES.gauche - MARGES.droite;
+        const hauteur = HAUTEUR - MARGES.haut - MARGES.bas;
+        const svg = element("svg", {viewBox: `0 0 ${LARGEUR} ${HAUTEUR}`, class: "img-fluid mb-5",
+                                    role: "img", "aria-label": serie.titre});
+        texte(serie.titre, {x: LARGEUR / 2, y: 22, "text-anchor": "middle", "font-size": 16}, svg);
+
+        const n = serie.y.length;
+        if (n === 0) {
+            texte("Aucune donnée", {x: LARGEUR / 2, y: HAUTEUR / 2, "text-anchor": "middle"}, svg);
+            conteneur.replaceChildren(svg);
+            return;
+        }
+        const ymin = Math.min(...serie.y), ymax = Math.max(...serie.y);
+        const marge = (ymax - ymin) * 0.05 || Math.abs(ymax) * 0.05 || 1;
+        const bas = ymin - marge, haut = ymax + marge;
+        // Abscisses à l'échelle de leur valeur, comme le PNG du serveur : un jour ou une
+        // semaine manquants laissent un écart. Seules les semaines "AAAA-Snn" sont par rang.
+        const dates = serie.abscisse !== "Semaine";
+        const valeurs = serie.x.map((x, i) => dates ? Date.parse(x) : (typeof x === "number" ? x : i));
+        const xmin = Math.min(...valeurs), xmax = Math.max(...valeurs);
+        const pxValeur = v => MARGES.gauche + (xmax === xmin ? largeur / 2 : (v - xmin) * largeur / (xmax - xmin));
+        const px = i => pxValeur(valeurs[i]);
+        const py = v => MARGES.haut + hauteur - (v - bas) / (haut - bas) * hauteur;
+
+        // Axes et graduations
+        element("rect", {x: MARGES.gauche, y: MARGES.haut, width: largeur, height: hauteur,
+                         fill: "none", stroke: "#333"}, svg);
+        graduations(ymin, ymax, 5).forEach(v => {
+            element("line", {x1: MARGES.gauche - 4, x2: MARGES.gauche, y1: py(v), y2: py(v), stroke: "#333"}, svg);
+            texte(format(v), {x: MARGES.gauche - 6, y: py(v) + 4, "text-anchor": "end", "font-size": 11}, svg);
+        });
+        const y = HAUTEUR - MARGES.bas + 14;
+        const etiquette = (contenu, x, numero) => {
+            const attributs = {x: x, y: y, "font-size": 11, "text-anchor": "middle"};
+            if (!numero) {
+                attributs["text-anchor"] = "end";
+                attributs.transform = `rotate(-45 ${x} ${y})`;
+            }
+            texte(contenu, attributs, svg);
+        };
+        if (dates) {
+            // Graduations régulièrement espacées dans le temps, pas sur les points
+            graduations(xmin, xmax, Math.min(n, 8)).forEach(t => {
+                etiquette(new Date(t).toISOString().slice(0, 10), pxValeur(t), false);
+            });
+        } else {
+            const pas = Math.max(1, Math.ceil(n / 14));
+            for (let i = 0; i < n; i += pas) {
+                // Semaine seule (numéro) ou, sur plusieurs années, déjà libellée "AAAA-Snn"
+                const numero = typeof serie.x[i] === "number";
+                etiquette(numero ? "S" + serie.x[i] : serie.x[i], px(i), numero);
+            }
+        }
+        if (serie.abscisse === "Semaine") {
+            texte("Semaine", {x: MARGES.gauche + largeur / 2, y: HAUTEUR - 12, "text-anchor": "middle", "font-size": 12}, svg);
+        }
+
+        // Courbe
+        const points = serie.y.map((v, i) => `${px(i)},${py(v)}`).join(" ");
+        element("polyline", {points: points, fill: "none", stroke: "#1f77b4", "stroke-width": 1.5}, svg);
+        serie.y.forEach((v, i) => {
+            const point = element("circle", {cx: px(i), cy: py(v), r: 3.5, fill: "#1f77b4"}, svg);
+            element("title", {}, point).textContent = `${serie.x[i]} : ${format(v)}`;
+        });
+        conteneur.replaceChildren(svg);
+    }
+
+    function charger(conteneur) {
+        // Pas plus de points que de pixels disponibles
+        const points = Math.max(4, Math.round((conteneur.clientWidth || LARGEUR) * (window.devicePixelRatio || 1)));
+        const url = conteneur.dataset.serie + (conteneur.dataset.serie.includes("?") ? "&" : "?") + "points=" + points;
+        fetch(url, {credentials: "same-origin"})
+            .then(reponse => reponse.ok ? reponse.json() : Promise.reject(reponse.status))
+            .then(serie => tracer(conteneur, serie))
+            .catch(() => {
+                conteneur.textContent = "Impossible de charger les données du graphique.";
+            });
+    }
+
+    document.querySelectorAll(".graphique-navigateur").forEach(charger);
+})();
@@ -0,0 +1,62 @@
+// Chargement à la demande des pages suivantes d'une liste (/api/rapports, /api/releves).
+// Usage : <tbody data-flux="/api/releves?site=SMP" data-suivant="2025-3" data-ligne="id_du_template">
+// suivi d'un bouton .charger-plus[data-liste="id_du_tbody"]. Chaque entrée est rendue par le
+// <template> désigné : ses éléments [data-champ] reçoivent la valeur du champ, ses éléments
+// [data-href] un lien dont les {champ} sont remplacés par les valeurs encodées, ses éléments
+// [data-miniatures] les miniatures des photos du champ désigné ({débitmètre: fichier}).
+
+(function () {
+    function valeur(entree, champ) {
+        const v = entree[champ] === undefined ? "" : String(entree[champ]);
+        return champ === "timestamp" ? v.replace("T", " ").slice(0, 19) : v;
+    }
+
+    function ligne(modele, entree) {
+        const fragment = modele.content.cloneNode(true);
+        fragment.querySelectorAll("[data-champ]").forEach(el => {
+            el.textContent = valeur(entree, el.dataset.champ);
+        });
+        fragment.querySelectorAll("[data-href]").forEach(el => {
+            el.href = el.dataset.href.replace(/\{(\w+)\}/g, (_, champ) => encodeURIComponent(valeur(entree, champ)));
+        });
+        fragment.querySelectorAll("[data-miniatures]").forEach(el => {
+            Object.entries(entree[el.dataset.miniatures] || {}).forEach(([nom, fichier]) => {
+                const chemin = fichier.split("/").map(encodeURIComponent).join("/");
+                const lien = document.createElement("a");
+                lien.href = "/photos_releves/" + chemin;
+                lien.target = "_blank";
+                lien.rel = "noopener";
+                const img = document.createElement("img");
+                Object.assign(img, {src: "/miniature/320/" + chemin, alt: nom, title: nom, height: 48, loading: "lazy"});
+                lien.appendChild(img);
+                el.appendChild(lien);
+            });
+        });
+        return fragment;
+    }
+
+    function charger(bouton) {
+        const liste = document.getElementById(bouton.dataset.liste);
+        const modele = document.getElementById(liste.dataset.ligne);
+        const url = liste.dataset.flux + (liste.dataset.flux.includes("?") ? "&" : "?")
+            + "avant=" + encodeURIComponent(liste.dataset.suivant);
+        bouton.disabled = true;
+        fetch(url, {credentials: "same-origin"})
+            .then(reponse => reponse.ok ? reponse.json() : Promise.reject(reponse.status))
+            .then(page => {
+                page.entrees.forEach(entree => liste.appendChild(ligne(modele, entree)));
+                liste.dataset.suivant = page.suivant || "";
+                bouton.hidden = !page.suivant;
+                bouton.disabled = false;
+            })
+            .catch(() => {
+                bouton.disabled = false;
+                bouton.textContent = "Erreur de chargement, réessayer";
+            });
+    }
+
+    document.querySelectorAll(".charger-plus").forEach(bouton => {
+        bouton.hidden = !document.getElementById(bouton.dataset.liste).dataset.suivant;
+        bouton.addEventListener("click", () => charger(bouton));
+    });
+})();